@@ -8,6 +8,16 @@ import data
 
 import flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.inspection import inspect
+from collections import defaultdict
+import functools
+import hashlib
+import hmac
+import orjson
+import time
+import urllib.parse
+import uuid
+import werkzeug.exceptions
 try:
     import relrest
 except ModuleNotFoundError:
@@ -17,18 +27,31 @@ except ModuleNotFoundError:
     import relrest
 
 app = flask.Flask(__name__)
+app.url_map.strict_slashes = False  # eg. /resource-index/ is served without a redirect
 
 app.config["SECRET_KEY"] = "changeme!"
 app.config["SQLALCHEMY_DATABASE_URI"] = data.engine.url
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = data.engine_options
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
-app.config["JSONIFY_PRETTYPRINT_REGULAR"] = True
+app.config["SQLALCHEMY_ECHO"] = app.debug  # echoing every statement is costly, keep it for development
+app.config["JSONIFY_PRETTYPRINT_REGULAR"] = False
 
 if app.config["DEBUG"]:
     relrest.log.setLevel(relrest.logging.DEBUG) # FIXME: not having any effect
+else:
+    relrest.logging.getLogger("sqlalchemy.engine").setLevel(relrest.logging.WARNING)
 
 db = SQLAlchemy(app)
 models = relrest.util.models_from(data)
+
+# Note: the models do not change at runtime, their fields and relations are inspected once
+resources_index = {}
+for name, model in models.items():
+    inspected = inspect(model)
+    resources_index[name] = {
+        "fields": inspected.columns.keys(),
+        "relations": inspected.relationships.keys()}
+
 rest_service = relrest.Service(db.session, models, roles={
     "*": {
         "event": ["create", "read", "update"]
@@ -44,6 +67,9 @@ users = {
     "admin": ("password", ["admin"]),
     "user": ("password", ["user"])}
 
+# Note: passwords are compared as digests, using a constant time comparison (see `authenticate()`)
+users_digest = {username: hashlib.sha256(password.encode()).digest() for username, (password, _) in users.items()}
+
 @app.before_request
 def authenticate_every_request():
     """
@@ -51,31 +77,53 @@ def authenticate_every_request():
     This allows http-basic-auth at once, eg when running
         curl user:password@localhost/resource/type
     """
-    authenticate()
+    authorization = flask.request.authorization
+    if not authorization or authorization.username != flask.session.get("username"):
+        authenticate()  # otherwise already authenticated by the session cookie
+
+    flask.g.roles = flask.session.get("roles", [])  # read the session once per request
+
+# Http status of the errors that are expected (ie. not logged)
+error_status = {
+    AssertionError: 403, # forbidden
+    ValueError: 400 # bad request
+}
 
 @app.errorhandler(Exception)
 def unhandled_exception(e):
-    import traceback
-    traceback.print_exc()
-    status = {
-        AssertionError: 403, # forbidden
-        ValueError: 400 # bad request
-    }.get(type(e), 500)
+    if isinstance(e, werkzeug.exceptions.HTTPException):
+        return e  # eg. 404 not found
+    status = error_status.get(type(e), 500)
+    if status == 500:
+        app.logger.exception(e)
     return dict(error=f"{e.__class__.__name__}: {e}"), status
 
+# Rendered root pages, by host and session (which the page displays), kept for `index_ttl` seconds
+index_cache = {}
+index_ttl = 60
+
 @app.route("/")
 def index():
     """
     Root page.
     """
-    import urllib
-    return flask.render_template("index.html",
+    key = (flask.request.host, repr(sorted(flask.session.items())))
+    cached = index_cache.get(key)
+    if cached and time.monotonic() - cached[0] < index_ttl:
+        return cached[1]
+
+    html = flask.render_template("index.html",
         service_info=service_info(),
         examples=examples(),
         rest_service=rest_service,
         users=users,
         unquote=urllib.parse.unquote)
 
+    if len(index_cache) > 128:
+        index_cache.clear()  # bound the cache (eg. arbitrary hosts)
+    index_cache[key] = (time.monotonic(), html)
+    return html
+
 @app.route("/authenticate")
 def authenticate():
     """
@@ -86,7 +134,8 @@ def authenticate():
         username = flask.request.authorization.username
         password = flask.request.authorization.password
 
-        if not users.get(username) or not users[username][0] == password:
+        digest = users_digest.get(username)
+        if not digest or not hmac.compare_digest(digest, hashlib.sha256(password.encode()).digest()):
             raise ValueError("Invalid credentials")
 
         flask.session["username"] = username
@@ -96,29 +145,105 @@ def authenticate():
         username=flask.session.get("username"),
         roles=flask.session.get("roles", []))
 
+# Rest service operation for each http method of `resource()`
+handlers = {
+       "PUT": lambda uri, roles: rest_service.create(uri, flask.request.json, roles),
+       "GET": lambda uri, roles: rest_service.read(uri, roles),
+      "HEAD": lambda uri, roles: read_head(uri, roles),
+     "PATCH": lambda uri, roles: rest_service.update(uri, flask.request.json, roles),
+    "DELETE": lambda uri, roles: rest_service.delete(uri, roles)}
+
 @app.route("/resource/<path:uri>", methods=["PUT", "GET", "PATCH", "DELETE", "HEAD"])
 def resource(uri):
     """
     Rest interface for CRUD operations.
     """
-    roles = flask.session.get("roles", [])
+    roles = flask.g.roles
     method = flask.request.method
-    uri = uri + "?" + flask.request.query_string.decode()  # join url and query string
-    handler = {
-           "PUT": lambda: rest_service.create(uri, flask.request.json, roles),
-           "GET": lambda: rest_service.read(uri, roles),
-          "HEAD": lambda: rest_service.read(uri, roles),  # eg. curl -I issues a HEAD request
-         "PATCH": lambda: rest_service.update(uri, flask.request.json, roles),
-        "DELETE": lambda: rest_service.delete(uri, id, roles)}
-
-    result = handler[method]()
+    uri = join_query_string(uri)
+
+    if method in ("GET", "HEAD"):
+        # Note: a client having a fresh copy of the resource gets a 304 without any database work,
+        # once it is authorized to read it
+        rest_service.authorize("read", decode_uri(uri), roles)
+        etag = resource_etag(uri, roles)
+        if flask.request.if_none_match.contains(etag):
+            response = flask.Response(status=304)
+            del response.headers["Content-Type"]  # a 304 has no body
+            response.set_etag(etag)
+            return response
+
+    result = handlers[method](uri, roles)
+
+    if method not in ("GET", "HEAD"):
+        # Note: the generations are bumped once the write is committed, so that a read
+        # concurrent to the write cannot get the ETag of the new generation with the former body
+        invalidate_resource(uri)
 
     # if "_debug" in flask.request.args:
     #     result = dict(result=result, debug=dict(
     #         uri=uri,
     #         decoded=relrest.util.uri.decode(uri)))
 
-    return flask.jsonify(result)
+    # Note: resources are serialized with orjson, which is much faster than flask.jsonify
+    # and serializes datetimes in ISO 8601 (eg. 2000-01-01T00:00:00+00:00)
+    if method == "HEAD":
+        # Note: the body of HEAD is neither serialized nor sent, nor is its Content-Length computed
+        response = flask.Response(mimetype="application/json")
+        response.automatically_set_content_length = False
+    else:
+        response = flask.Response(orjson.dumps(result, option=orjson.OPT_NAIVE_UTC), mimetype="application/json")
+    if method in ("GET", "HEAD"):
+        response.set_etag(etag)
+    return response
+
+def read_head(uri, roles):
+    """
+    Read the given `uri` as GET does, for its status only: the query is run and its first record
+    is read (eg. NoResultFound for a missing id), but the records are neither all fetched nor serialized.
+    """
+    result = rest_service.read(uri, roles, stream=True)
+    if not isinstance(result, dict):
+        next(iter(result), None)  # runs the query, its errors are the ones of GET
+
+def join_query_string(uri):
+    """
+    Return the given `uri` joined with the query string of the current request, if any
+    (a query-less uri is left as is, it also makes a single cache key for `decode_uri()`).
+    """
+    query_string = flask.request.query_string
+    return f"{uri}?{query_string.decode()}" if query_string else uri
+
+# Note: uri decoding is pure and the same uris recur, so decoded uris are cached;
+# the returned relrest-request is shared, it is immutable (see `relrest.util.uri.Request`).
+decode_uri = functools.lru_cache(maxsize=4096)(relrest.util.uri.decode)
+
+# Per-resource generation counters, bumped on every write on the resource,
+# they make the ETag of a read change when any resource it involves is written.
+generations = defaultdict(int)
+etag_seed = uuid.uuid4().hex  # ETags do not survive a restart (eg. after data.populate())
+
+def resource_etag(uri, roles):
+    """
+    Return the ETag of the read of the given `uri` for the given `roles`.
+    """
+    request = decode_uri(uri)
+    resources = {
+        request.resource,
+        *[f_resource for f_resource, _ in request.fields],
+        *[f_resource for f_resource, _, _, _ in request.filters],
+        *[j_resource for joinpath in request.joinpaths for j_resource, _, _, _ in joinpath]}
+    state = (etag_seed, uri, sorted(roles), sorted((r, generations.get(r, 0)) for r in resources if r))
+    return hashlib.blake2b(repr(state).encode(), digest_size=16).hexdigest()
+
+def invalidate_resource(uri):
+    """
+    Bump the generation of the resource written by the given `uri`,
+    and of its related resources whose relationships may change along.
+    """
+    resource = decode_uri(uri).resource
+    for r in [resource, *resources_index.get(resource, {}).get("relations", [])]:
+        generations[r] += 1
 
 
 # Some meta information about the resources and the service
@@ -133,15 +258,7 @@ def resource_index():
     """
     Return the resource index with resources name and uri.
     """
-    from sqlalchemy.inspection import inspect
-    resources = {}
-    for resource in rest_service.model.keys():
-        inspected = inspect(rest_service.model[resource])
-        resources[resource] = {
-            "fields": inspected.columns.keys(),
-            "relations": inspected.relationships.keys()
-        }
-    return resources
+    return resources_index
 
 @app.route("/decode/<path:uri>")
 def decode(uri):
@@ -151,13 +268,13 @@ def decode(uri):
     return the raw value `as_received`, the `decoded` object and the re-`encoded` uri string.
     """
     # TODO: add the generated sql (prepare statement) !
-    uri = uri + "?" + flask.request.query_string.decode()  # Note: marshalling here (returns an equivalent but not always identical uri)
-    decoded = relrest.util.uri.decode(uri)
+    uri = join_query_string(uri)  # Note: marshalling here (returns an equivalent but not always identical uri)
+    decoded = decode_uri(uri)
     encoded = relrest.util.uri.encode(**decoded)
     return dict(
         uri=dict(
             as_received=uri,
-            decoded=decoded,
+            decoded=decoded._asdict(),
             encoded=encoded))
 
 @app.route("/service-info")
@@ -165,6 +282,13 @@ def service_info():
     """
     Return information about `relrest.Service`.
     """
+    return service_info_cached()
+
+@functools.lru_cache(maxsize=1)
+def service_info_cached():
+    """
+    Return `service_info()` computed once, as it does not change at runtime.
+    """
     engine = rest_service.session.get_bind()
     return {
         "relrest.version": "#todo",
@@ -192,139 +316,138 @@ def examples():
 
         - uri: a list of URI examples formatted for RelRest
     """
-    # TODO: this example dataset could be stored in database, for une mise en abime sympa
-    import urllib  # unquote urls for readability
-    examples = {
-            "Base queries": [
-                ("Get all tags",
-                    "tag"),
-                ("Get tag 1",
-                    "tag/1"),
-            ],
-
-            "Filters": [
-                ("Get tag 1",
-                    "tag?id=1"),
-                ("Get tag 1",
-                    "tag?id.eq=1"),
-                ("Get tag 1",
-                    "tag?tag.id.eq=1"),
-                ("Get tags starting with 'a'",
-                    "tag?name.like=a%"),
-                ("Get tags starting with 'a' and id in 1,2,3",
-                    "tag?name.like=a%&id.in=1,2,3"),
-                ("Get tags with name starting with 'a' and id greater than 10",
-                    "tag?name.like=a%&id.gt=10"),
-            ],
-
-            "Limit and count (offset is todo)": [
-                ("Get tag with limit 10",
-                    "tag?_limit=10"),
-                ("Count tags (id=+ means any id)",
-                    "tag/+/:count"),
-                ("Count tags with name starting with 'a'",
-                    "tag/+/:count?name.like=a%"),
-            ],
-
-            "Resource-less (or relational) requests using join-paths": [
-                ("Get all resource (not allowed: a join-path is required)",
-                    "+"),
-                ("Get all tags",
-                    "+?/tag"),
-                ("Get tag 1",
-                    "+?/tag=1"),
-                ("Get tag 1",
-                    "+?/tag.id=1"),
-                ("Get tag 1",
-                    "+?/tag.id.eq=1"),
-                ("Get tags with id greater than 50",
-                    "+?/tag.id.gt=50"),
-                ("Get tags starting with 'a'",
-                    "+?/tag.name.like=a%"),
-                ("Get combinations of tags starting with 'a' and events having a summary starting with 'l'",
-                    "+?/tag.name.like=A%&/event.summary.like=l%"),
-                ("Get tags starting with 'a' that have an event summary starting with 'l'",
-                    "+?/tag.name.like=A%/event.summary.like=l%"),
-                ("Get tags starting with 'a' that have an event summary starting with 'l', returning the first resource of each join path (here: tag)",
-                    "-?/tag.name.like=A%/event.summary.like=l%"),
-            ],
-
-            "Join-paths: Combinaisons (without joins, as a starter)": [
-                ("Count the tag resource: traditional way = 100",
-                    "tag/+/:count"),
-                ("Count the tag resource: combinatory way = 100",
-                    "+/+/:count?/tag"),
-                ("Count the event resource = 1000",
-                    "+/+/:count?/event"),
-                ("Count the combinations of tag with event resources = 100000",
-                    "+/+/:count?/tag&/event"),
-                ("Count the combinations of tag resource 1 with all event resources = 1000",
-                    "+/+/:count?/tag=1&/event"),
-                ("Count the combinations of event resource 1 with all tag resources = 100",
-                    "+/+/:count?/tag&/event=1"),
-                ("Count the combinations of event resource 1 with tag resource 1 = 1",
-                    "+/+/:count?/tag=1&/event=1"),
-                ("Count the combinations of event resource 1,2,3 with all tag resources = 3000",
-                    "+/+/:count?/tag.id.in=1,2,3&/event"),
-                ("Count the combinations of event resource 1,2,3 with tag resources 1 = 3",
-                    "+/+/:count?/tag.id.in=1,2,3&/event=1"),
-                ("Count the combinations of event resource 1,2,3 with tag resources 1,2,3 = 9",
-                    "+/+/:count?/tag.id.in=1,2,3&/event.id.in=1,2,3"),
-                ("Get the data of the combinations of event resource 1,2,3 with tag resources 1,2,3...",
-                    "+?/tag.id.in=1,2,3&/event=1"),
-            ],
-
-            "Join-paths: Relations (with joins)": [
-                ("Count the relations between events and tags",
-                    "+/+/:count?/tag/event"),
-                ("Count the relations between tags and events (same result as above)",
-                    "+/+/:count?/event/tag"),
-                ("Count the relations between tags with id >50 and events",
-                    "+/+/:count?/tag.id.ge=50/event"),
-                ("Count the relations between tags with id >50 events starting with 'a'",
-                    "+/+/:count?/tag.id.ge=50/event.summary.like=a%"),
-                ("Get relations between tags with an id >50 and events starting with 'a', returning the tag and event records tuples",
-                    "+?/tag.id.ge=50/event.summary.like=a%"),
-                ("Get relations between tags with an id >50 and events starting with 'a', returning the tag records",
-                    "-?/tag.id.ge=50/event.summary.like=a%"),
-            ],
-
-            "Fields selection": [
-                ("Get the time of event 1 (id is always returned, eagely loaded relationships are always returned for now)",
-                    "event/1/time"),
-                ("Get the time of all events",
-                    "event/+/time"),
-                ("Get the summary and time of all events",
-                    "event/+/time,summary"),
-                ("Get the summary and time of all events and the color of their tags (#fixme)",
-                    "+/+/event.time,event.summary,tag.color?/event/tag"),
-            ]
-    }
-
-    # "resource",
-
-    # "resource/id",
-
-    # "resource/id/field1",
-
-    # "resource/id/field1,field2",
-
-    # "resource/id/field1,field2?"
-    # "field1=value1",
-
-    # "resource/id/field1,field2?"
-    # "field1=value1"
-    # "&field2.id.in=1,2,3",
-
-    # "resource/id/field1,field2?"
-    # "field1=value1"
-    # "&field2.id.in=1,2,3"
-    # "&/resource/relation",
-
-    # "resource/id/field1,field2?"
-    # "field1=value1"
-    # "&field2.id.in=1,2,3"
-    # "&/resource/relation"
-    # "&/resource/other_relation.name.like=The%"]]
-
-    return examples
+    return examples_by_section
+
+# TODO: this example dataset could be stored in database, for une mise en abime sympa
+examples_by_section = {
+    "Base queries": [
+        ("Get all tags",
+            "tag"),
+        ("Get tag 1",
+            "tag/1"),
+    ],
+
+    "Filters": [
+        ("Get tag 1",
+            "tag?id=1"),
+        ("Get tag 1",
+            "tag?id.eq=1"),
+        ("Get tag 1",
+            "tag?tag.id.eq=1"),
+        ("Get tags starting with 'a'",
+            "tag?name.like=a%"),
+        ("Get tags starting with 'a' and id in 1,2,3",
+            "tag?name.like=a%&id.in=1,2,3"),
+        ("Get tags with name starting with 'a' and id greater than 10",
+            "tag?name.like=a%&id.gt=10"),
+    ],
+
+    "Limit and count (offset is todo)": [
+        ("Get tag with limit 10",
+            "tag?_limit=10"),
+        ("Count tags (id=+ means any id)",
+            "tag/+/:count"),
+        ("Count tags with name starting with 'a'",
+            "tag/+/:count?name.like=a%"),
+    ],
+
+    "Resource-less (or relational) requests using join-paths": [
+        ("Get all resource (not allowed: a join-path is required)",
+            "+"),
+        ("Get all tags",
+            "+?/tag"),
+        ("Get tag 1",
+            "+?/tag=1"),
+        ("Get tag 1",
+            "+?/tag.id=1"),
+        ("Get tag 1",
+            "+?/tag.id.eq=1"),
+        ("Get tags with id greater than 50",
+            "+?/tag.id.gt=50"),
+        ("Get tags starting with 'a'",
+            "+?/tag.name.like=a%"),
+        ("Get combinations of tags starting with 'a' and events having a summary starting with 'l'",
+            "+?/tag.name.like=A%&/event.summary.like=l%"),
+        ("Get tags starting with 'a' that have an event summary starting with 'l'",
+            "+?/tag.name.like=A%/event.summary.like=l%"),
+        ("Get tags starting with 'a' that have an event summary starting with 'l', returning the first resource of each join path (here: tag)",
+            "-?/tag.name.like=A%/event.summary.like=l%"),
+    ],
+
+    "Join-paths: Combinaisons (without joins, as a starter)": [
+        ("Count the tag resource: traditional way = 100",
+            "tag/+/:count"),
+        ("Count the tag resource: combinatory way = 100",
+            "+/+/:count?/tag"),
+        ("Count the event resource = 1000",
+            "+/+/:count?/event"),
+        ("Count the combinations of tag with event resources = 100000",
+            "+/+/:count?/tag&/event"),
+        ("Count the combinations of tag resource 1 with all event resources = 1000",
+            "+/+/:count?/tag=1&/event"),
+        ("Count the combinations of event resource 1 with all tag resources = 100",
+            "+/+/:count?/tag&/event=1"),
+        ("Count the combinations of event resource 1 with tag resource 1 = 1",
+            "+/+/:count?/tag=1&/event=1"),
+        ("Count the combinations of event resource 1,2,3 with all tag resources = 3000",
+            "+/+/:count?/tag.id.in=1,2,3&/event"),
+        ("Count the combinations of event resource 1,2,3 with tag resources 1 = 3",
+            "+/+/:count?/tag.id.in=1,2,3&/event=1"),
+        ("Count the combinations of event resource 1,2,3 with tag resources 1,2,3 = 9",
+            "+/+/:count?/tag.id.in=1,2,3&/event.id.in=1,2,3"),
+        ("Get the data of the combinations of event resource 1,2,3 with tag resources 1,2,3...",
+            "+?/tag.id.in=1,2,3&/event=1"),
+    ],
+
+    "Join-paths: Relations (with joins)": [
+        ("Count the relations between events and tags",
+            "+/+/:count?/tag/event"),
+        ("Count the relations between tags and events (same result as above)",
+            "+/+/:count?/event/tag"),
+        ("Count the relations between tags with id >50 and events",
+            "+/+/:count?/tag.id.ge=50/event"),
+        ("Count the relations between tags with id >50 events starting with 'a'",
+            "+/+/:count?/tag.id.ge=50/event.summary.like=a%"),
+        ("Get relations between tags with an id >50 and events starting with 'a', returning the tag and event records tuples",
+            "+?/tag.id.ge=50/event.summary.like=a%"),
+        ("Get relations between tags with an id >50 and events starting with 'a', returning the tag records",
+            "-?/tag.id.ge=50/event.summary.like=a%"),
+    ],
+
+    "Fields selection": [
+        ("Get the time of event 1 (id is always returned, eagely loaded relationships are always returned for now)",
+            "event/1/time"),
+        ("Get the time of all events",
+            "event/+/time"),
+        ("Get the summary and time of all events",
+            "event/+/time,summary"),
+        ("Get the summary and time of all events and the color of their tags (#fixme)",
+            "+/+/event.time,event.summary,tag.color?/event/tag"),
+    ]
+}
+
+# "resource",
+
+# "resource/id",
+
+# "resource/id/field1",
+
+# "resource/id/field1,field2",
+
+# "resource/id/field1,field2?"
+# "field1=value1",
+
+# "resource/id/field1,field2?"
+# "field1=value1"
+# "&field2.id.in=1,2,3",
+
+# "resource/id/field1,field2?"
+# "field1=value1"
+# "&field2.id.in=1,2,3"
+# "&/resource/relation",
+
+# "resource/id/field1,field2?"
+# "field1=value1"
+# "&field2.id.in=1,2,3"
+# "&/resource/relation"
+# "&/resource/other_relation.name.like=The%"]]
@@ -0,0 +1,16 @@
+"""
+RelRest web service example, served by a gevent WSGI server.
+
+Run from the `example` directory with:
+    python -m app
+"""
+
+# Note: monkey patching must happen before flask and sqlalchemy are imported
+from gevent import monkey; monkey.patch_all()
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from app import app
+
+WSGIServer(("", 5000), app.wsgi_app, spawn=Pool(1000)).serve_forever()  # cap concurrent requests
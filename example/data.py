@@ -4,14 +4,28 @@ RelRest database example.
 
 # See: https://docs.sqlalchemy.org/en/13/orm/tutorial.html
 
+import sqlalchemy
 from sqlalchemy import *
 from sqlalchemy import orm
 from sqlalchemy.ext import declarative
+from sqlalchemy.pool import QueuePool
 from datetime import datetime
+import os
 
 # SQLA engine, session and declarative_base
 uri = "sqlite:////tmp/relrest-example.sqlite"  # FIXME: /tmp is wiped on reboots
-engine = create_engine(uri, echo=True)
+engine_options = {  # also used by the flask example app, see app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+    # keep sqlite connections open across requests instead of reopening the file on each checkout
+    # (sqlite file databases default to NullPool), connections are shared between the server threads
+    "poolclass": QueuePool,
+    "connect_args": {"check_same_thread": False}}
+if tuple(map(int, sqlalchemy.__version__.split(".")[:2])) >= (1, 4):
+    # size the compiled statement cache, see https://docs.sqlalchemy.org/en/14/core/connections.html#sql-compilation-caching
+    # (SQLAlchemy<1.4 has no such cache)
+    engine_options["query_cache_size"] = 1200
+engine = create_engine(uri, echo=os.environ.get("SQL_ECHO") == "1", **engine_options)  # eg. SQL_ECHO=1 flask run
+if "query_cache_size" in engine_options:
+    assert engine.dialect.supports_statement_cache, f"Dialect {engine.dialect.name} does not support statement caching"
 Session = orm.sessionmaker(bind=engine)
 Base = declarative.declarative_base()
 # metadata = MetaData()
@@ -56,13 +70,20 @@ class Tag(Base):
 
 # Data population:
 
+def chunks(n_children, n_parents):
+    """
+    Return the (lo, up) bounds of the `n_parents` chunks of `n_children` items, computed at once.
+    The leftover children are spread over the parents so that chunk sizes differ by at most one.
+    """
+    bounds = [n_children * shift // n_parents for shift in range(n_parents + 1)]
+    return list(zip(bounds, bounds[1:]))
+
 def populate():
     """
     Drop and create database schema and populate a example dataset for development purpose.
     """
 
     from faker import Faker
-    import math
 
     fake = Faker("fr_FR")  # french touch
     def generate(kind, n=10):
@@ -74,9 +95,11 @@ def populate():
                 if not k.startswith("_") and k not in ["add_provider", "random", "factories"]]
             raise ValueError(f"Invaid kind '{kind}', try one of {kinds}")
 
-        items = set()
+        provider = getattr(fake, kind)
+        items = {provider() for _ in range(n)}
         while len(items) < n:
-            items.add(getattr(fake, kind)())
+            # top up the duplicates that were discarded
+            items.add(provider())
 
         return items
 
@@ -85,27 +108,14 @@ def populate():
         children = records[child]
         parents = records[parent]
 
-        per_parent = len(children) / len(parents)
-
-        if per_parent < 1:
+        if len(children) < len(parents):
             # the logic below only works with a number of children > parents
             # simply invert everything to chunk the given parents instead of the given children children
             children, parents = parents, children
             parent, child = child, parent
-            per_parent = 1 / per_parent
 
         print(f'\nDistributing children "{child}" to parents "{parent}":')
-        for shift, parent_record in enumerate(parents):
-            # floor will make leftover children, but never a lack for a parent
-            chunksize = math.floor(per_parent)
-            lo = chunksize * shift
-            up = chunksize * (shift + 1)
-
-            if shift == len(parents) - 1:
-                # last iteration: include the potential remaining children from floor
-                # there is a better a method of quatization
-                up = len(children)
-
+        for shift, (parent_record, (lo, up)) in enumerate(zip(parents, chunks(len(children), len(parents)))):
             print(f'adding ({lo}:{up}) {up-lo}/{len(children)} children "{child}" to parent "{parent}" {shift+1}/{len(parents)}')#' ({parent_record})')
             relation = getattr(parent_record, child)
             relation.extend(children[lo:up])
@@ -141,13 +151,23 @@ def populate():
     # distribute('tag', 'tag')  # FIXME
     distribute('tag', 'event')
     distribute('type', 'event')
+
+    # Note: ids are assigned here so that records and their relationships can be bulk inserted,
+    # rather than flushed row by row by the session unit of work.
+    for model, model_records in records.items():
+        for id, record in enumerate(model_records, 1):
+            record.id = id
+
     dataset = [record for model, records in records.items() for record in records]
 
     Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
 
     session = Session()
-    for record in dataset:
-        session.add(record)
+    session.bulk_save_objects(dataset)  # Note: relationships are ignored, they are inserted below
+    session.execute(nn_event_tag.insert(), [
+        dict(event_id=event.id, tag_id=tag.id) for event in records['event'] for tag in event.tag])
+    session.execute(nn_event_type.insert(), [
+        dict(event_id=event.id, type_id=type.id) for event in records['event'] for type in event.type])
 
     session.commit()
@@ -32,6 +32,8 @@ Conventions:
 TODO: unhardcode default primary key for models (currently 'id')
 and make it configurable by the user, globally but also via an optional per-model mapping,
 maybe via a hook like we do with the relational field (see `get_relcolumn()`).
+The queries and the serialized relations use the (first) primary key column of the models
+(see `get_primary_key()` and `util.get_model_fields()`), but the uris still name it 'id' by default (see `default_field`).
 
 TODO: make clean implementation of the relational field hook `get_relcolumn()`.
 """
@@ -39,9 +41,14 @@ TODO: make clean implementation of the relational field hook `get_relcolumn()`.
 from . import util
 
 import sqlalchemy
+import sqlalchemy.ext.baked
 
 from collections import defaultdict
+import contextlib
+import functools
 import logging
+import operator
+import types
 
 log = logging.getLogger(__name__)  # logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(filename)s:%(lineno)s - %(name)s.%(funcName)s - %(levelname)s - %(message)s")
 
@@ -60,6 +67,77 @@ reserved_ids = ["+", "-"]
 # Value '-' returns the records for resources specified in first node of each joinpath.
 reserved_resources = ["+", "-"]
 
+# Note: key of the depth of nested `Service.transaction()` contexts in the sqla session `info` dict
+transactions_key = "relrest.transactions"
+
+# Note: operations on resources are: create, read, update and delete (see `Service.add_roles()`)
+all_operations = frozenset("crud")
+
+# Note: sqla filter for each comparator, given a sqla column and a marshalled value (see `Service.make_filter()`)
+comparators = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'lt': operator.lt,
+    'le': operator.le,
+    'gt': operator.gt,
+    'ge': operator.ge,
+    'like': lambda column, value: column.like(value),
+    'ilike': lambda column, value: column.ilike(value),
+    'in': lambda column, value: column.in_(value),
+    'notin': lambda column, value: column.notin_(value)}
+
+# Note: marshalling of filter values for each sqla column type (see `Service.make_filter()`)
+casts = {
+    sqlalchemy.sql.sqltypes.Integer: lambda value: int(value),
+    sqlalchemy.sql.sqltypes.Boolean: lambda value: True if not value.isnumeric() else bool(int(value))}
+
+@functools.lru_cache(maxsize=None)
+def get_cast(column_type):
+    """
+    Return the marshalling function for filter values of the given sqla `column_type` class,
+    resolved along its class hierarchy (eg. a sqla BigInteger is an Integer), see `casts`.
+    """
+    for type_ in column_type.__mro__:
+        if type_ in casts:
+            return casts[type_]
+    return lambda value: value
+
+@functools.lru_cache(maxsize=None)
+def get_primary_key(model):
+    """
+    Return the primary key column of the given sqla `model`, eg. data.Event.id,
+    the first column of composite primary keys.
+    """
+    mapper = sqlalchemy.inspect(model)
+    return getattr(model, mapper.get_property_by_column(mapper.primary_key[0]).key)
+
+def column_kind(column):
+    """
+    Return the kind of the given sqla `column`, as handled by `Service.set_properties()`:
+    'scalar', 'relationship' (..1 relationship), 'collection' (..n relationship)
+    or None if the column is not supported.
+    """
+    if type(column.impl) == sqlalchemy.orm.attributes.ScalarAttributeImpl:
+        return "scalar"
+    if util.is_relationship(column):
+        if isinstance(column.impl, sqlalchemy.orm.attributes.ScalarObjectAttributeImpl):
+            return "relationship"
+        if isinstance(column.impl, sqlalchemy.orm.attributes.CollectionAttributeImpl):
+            return "collection"
+    return None
+
+@functools.lru_cache(maxsize=4096)
+def decode_cached(uri, default_field, default_comparator, default_direction):
+    """
+    Return `util.uri.decode()` for the given arguments, cached because the same uris recur.
+    The returned relrest-request is shared between calls, it is immutable (see `util.uri.Request`).
+    """
+    return util.uri.decode(uri,
+        default_resource=None,
+        default_field=default_field,
+        default_comparator=default_comparator,
+        default_direction=default_direction)
+
 class Service(object):
 
     # FIXME: make those defaults non-static
@@ -102,17 +180,66 @@ class Service(object):
         """
         super().__init__()
 
-        for key, not_model in filter(lambda model: not util.is_model(model), sqla_model_dict.values()):
-            raise ValueError(f"Argument sqla_model_dict contains a key '{key}'={model} which is not a sqla model")
+        not_models = {key: value for key, value in sqla_model_dict.items() if not util.is_model(value)}
+        if not_models:
+            raise ValueError(f"Argument sqla_model_dict contains items {not_models} which are not sqla models")
 
         self.session = sqla_session
 
-        self._model = sqla_model_dict
-        self._resource = {v: k for k, v in self._model.items()}
-
-        self.rights = defaultdict(lambda: defaultdict(set))
+        # Note: resources are interned as well as the resources decoded from uris (see `util.uri.intern()`)
+        # Note: the mappings are read-only, since the tables computed below are derived from them
+        self._model = types.MappingProxyType({util.uri.intern(resource): model for resource, model in sqla_model_dict.items()})
+        self._resource = types.MappingProxyType({v: k for k, v in self._model.items()})
+
+        # Note: labeled non-relationship columns of each model by field, selected by resourceless requests, eg:
+        #   self._labeled_columns[data.Event]["time"] == data.Event.time.label("event.time")
+        self._labeled_columns = {
+            model: {
+                column_attr.key: column_attr.class_attribute.label(f"{self._resource[model]}.{column_attr.key}")
+                for column_attr in sqlalchemy.inspect(model).column_attrs}
+            for model in self._model.values()}
+
+        # Note: column and kind of column of each field of each resource (see `column()`), eg:
+        #   self._columns["event", "tag"] == (data.Event.tag, "collection")
+        self._columns = {
+            (resource, attr.key): (getattr(model, attr.key), column_kind(getattr(model, attr.key)))
+            for resource, model in self._model.items()
+            for attr in model._sa_class_manager.attributes}
+
+        # Note: relations trie, walked along the joinpaths (see `read_resource()`), eg:
+        #   self._relations[data.Event]["tag"] == (data.Tag, data.Event.tag)
+        # TODO: the relational field hook `get_relcolumn()` should allow the user to specify a function
+        # to generate the name of the local model column that is related to foreign model represented by a resource,
+        # for now the relationship must be named after the resource.
+        self._relations = {
+            model: {
+                relationship.key: (self._model[relationship.key], getattr(model, relationship.key))
+                for relationship in sqlalchemy.inspect(model).relationships
+                if relationship.key in self._model}
+            for model in self._model.values()}
+
+        # Note: query builders are cached by request shape (see `query_builder()`),
+        # the sqla queries they build and their compiled statements are cached in the bakery
+        self._query_builder = functools.lru_cache(maxsize=512)(self.query_builder)
+        self._bakery = sqlalchemy.ext.baked.bakery(size=512)
+
+        self.rights = {}
         self.add_roles(**roles)
 
+    def current_session(self):
+        """
+        Return the sqla session used by the current thread (or greenlet) if `self.session`
+        is a sqla scoped session, or `self.session` itself otherwise.
+        """
+        return self.session() if isinstance(self.session, sqlalchemy.orm.scoped_session) else self.session
+
+    def in_transaction(self):
+        """
+        Return True if the current session is within a `transaction()` context,
+        in which case the writes are not committed by `create()`, `update()` and `delete()`.
+        """
+        return bool(self.current_session().info.get(transactions_key))
+
     def add_roles(self, **roles_descriptions):
         """
         Add the given `roles` description to `self.rights`.
@@ -129,40 +256,66 @@ class Service(object):
         for role, role_description in roles_descriptions.items():
             for resource, operations in role_description.items():
 
+                # Note: operations are parsed once into runs of additions and removals of operations,
+                # the order of the runs matters, eg. ["*", "-delete"] -> [(False, {c, r, u, d}), (True, {d})]
+                runs = []
+                for operation in operations:
+                    discard = operation[:1] == "-"
+                    op = (operation[1:] if discard else operation).lower()
+                    ops = set(all_operations) if op == "*" else {op[:1]}
+                    if not ops <= all_operations:
+                        raise ValueError(f"Invalid operation '{operation}' (on resource '{resource}' for role '{role}')")
+
+                    if runs and runs[-1][0] == discard:
+                        runs[-1][1].update(ops)
+                    else:
+                        runs.append((discard, ops))
+
                 if resource == "*":
                     resources_expanded = self.model.keys()
                 else:
                     resources_expanded = [resource]
 
-                for resource_expanded in resources_expanded:
-
-                    for operation in operations:
+                roles_expanded += [(role, resource_expanded, discard, ops)
+                    for resource_expanded in resources_expanded
+                    for discard, ops in runs]
 
-                        if operation == "*":
-                            operations_expanded = ["c", "r", "u", "d"]
-                        elif operation == "-*":
-                            operations_expanded = ["-c", "-r", "-u", "-d"]
-                        else:
-                            operations_expanded = [operation]
-
-                        for operation_expanded in operations_expanded:
-
-                            discard = operation_expanded[0] == "-"
-                            op = (operation_expanded[1] if discard else operation_expanded[0]).lower()
-                            if op not in "crud":
-                                raise ValueError(f"Invalid operation '{operation}' (on resource '{resource}' for role '{role}')")
-
-                            roles_expanded.append((role, resource_expanded, op, discard))
+        rights = defaultdict(lambda: defaultdict(set))
+        for role, role_rights in self.rights.items():
+            for resource, ops in role_rights.items():
+                rights[role][resource].update(ops)
 
-        for role, resource, op, discard in roles_expanded:
+        for role, resource, discard, ops in roles_expanded:
             # add roles after validation of everything
             if discard:
-                self.rights[role][resource].discard(op)
+                rights[role][resource].difference_update(ops)
             else:
-                self.rights[role][resource].add(op)
+                rights[role][resource].update(ops)
+
+        # Note: rights are frozen once computed, so that looking them up never mutates them
+        self.rights = {
+            role: {resource: frozenset(ops) for resource, ops in role_rights.items()}
+            for role, role_rights in rights.items()}
 
         for role, role_rights in self.rights.items():
-            print(f"Computed rights for role {role}:", dict(role_rights))
+            log.debug(f"Computed rights for role {role}: {role_rights}")
+
+        # Note: rights are inverted into the roles granted each operation on each resource,
+        # so that `authorize()` checks a resource with a single lookup
+        granted_roles = defaultdict(set)
+        for role, role_rights in self.rights.items():
+            for resource, ops in role_rights.items():
+                for op in ops:
+                    granted_roles[(op, resource)].add(role)
+        self._granted_roles = {key: frozenset(roles) for key, roles in granted_roles.items()}
+        # resources on which the default role "*" is granted an operation
+        default_rights = self.rights.get("*", {})
+        self._default_resources = {op: frozenset(resource for resource, ops in default_rights.items() if op in ops)
+                                   for op in all_operations}
+        # roles granted an operation on every resource, eg. by {"*": ["*"]}
+        self._wildcard_roles = {op: frozenset(role for role, role_rights in self.rights.items()
+                                              if all(op in role_rights.get(resource, ()) for resource in self.model))
+                                for op in all_operations}
 
     def authorize(self, operation, request, for_roles):
         """
@@ -181,12 +334,19 @@ class Service(object):
             return  # empty self.rights means disabled authorization
 
         operation = operation[0]  # 'c' or 'r' or 'u' or 'd'
+        anonymous = not for_roles
         for_roles = ["*", *for_roles]  # role "*" is the default role that anybody is granted
-        resources_involved = [request["resource"]] if request["resource"] not in reserved_resources else []
-        resources_involved += [resource for joinpath in request['joinpaths'] for resource, _, _, _  in joinpath]
-        allowed = any(operation in self.rights[for_role][resource_involved]
-            for resource_involved in resources_involved
-            for for_role in for_roles)
+        if not anonymous and request.resource in self._model and not self._wildcard_roles[operation].isdisjoint(for_roles):
+            return  # the operation is allowed on any resource for one of the roles
+        resources_involved = [request.resource] if request.resource not in reserved_resources else []
+        resources_involved.extend(joinnode[0] for joinpath in request.joinpaths for joinnode in joinpath)
+        resources_involved = list(dict.fromkeys(resources_involved))  # each resource is checked once, in order
+        if anonymous:
+            # Note: the default role alone is checked against the resources it is granted the operation on
+            allowed = not self._default_resources[operation].isdisjoint(resources_involved)
+        else:
+            allowed = any(not self._granted_roles.get((operation, resource_involved), frozenset()).isdisjoint(for_roles)
+                for resource_involved in resources_involved)
 
         if not allowed:
             raise AssertionError(
@@ -197,12 +357,17 @@ class Service(object):
         """
         Return `util.uri.decode(uri)` with default field and comparator
         from this instance `default_field` and `default_comparator` properties.
+
+        The decoded relrest-request is cached (see `decode_cached()`) and shared between the calls,
+        it is immutable: use `request._replace()` to derive a modified request (see `util.uri.Request`).
+        """
+        return decode_cached(uri, self.default_field, self.default_comparator, self.default_direction)
+
+    def clear_decode_cache(self):
+        """
+        Clear the cache of the decoded uris (see `decode_cached()`), eg. between tests.
         """
-        return util.uri.decode(uri,
-            default_resource=None,
-            default_field=self.default_field,
-            default_comparator=self.default_comparator,
-            default_direction=self.default_direction)
+        decode_cached.cache_clear()
 
     def create(self, uri, record, for_roles=[]):
         """
@@ -213,16 +378,19 @@ class Service(object):
         self.authorize("create", request, for_roles)
 
         record = self.create_resource(
-            resource=request["resource"],
-            record=record)
+            resource=request.resource,
+            record=record,
+            commit=not self.in_transaction())
 
         return self.read_resource(
-            resource=request["resource"],
-            id=record.id)
+            resource=request.resource,
+            id=getattr(record, get_primary_key(type(record)).key))
 
-    def read(self, uri, for_roles=[]):
+    def read(self, uri, for_roles=[], stream=False):
         """
         Read and return record(s) for the given `uri`.
+
+        If `stream` is True, multiple records are returned as a generator (see `read_resource()`).
         """
         request = self.decode(uri)
 
@@ -231,13 +399,14 @@ class Service(object):
         log.debug(f"Reading 'uri={uri}' decoded into {request}")
 
         return self.read_resource(
-            resource=request["resource"],
-            id=request["id"],
-            fields=request["fields"],
-            filters=request["filters"],
-            joinpaths=request["joinpaths"],
-            order=request["order"],
-            limit=request["limit"])
+            resource=request.resource,
+            id=request.id,
+            fields=request.fields,
+            filters=request.filters,
+            joinpaths=request.joinpaths,
+            order=request.order,
+            limit=request.limit,
+            stream=stream)
 
     def update(self, uri, record, for_roles=[]):
         """
@@ -250,43 +419,75 @@ class Service(object):
 
         self.authorize("update", request, for_roles)
 
-        if request["fields"]:
+        if request.fields:
             # ignore fields description in rest request
             # raise ValueError(f"Update operation does not support fields in URI and field '{fields}' was given")
             pass
 
         self.update_resource(
-            resource=request["resource"],
-            id=request["id"],
-            record=record)
+            resource=request.resource,
+            id=request.id,
+            record=record,
+            commit=not self.in_transaction())
 
         return self.read_resource(
-            resource=request["resource"],
-            id=request["id"],
-            fields=request["fields"])
+            resource=request.resource,
+            id=request.id,
+            fields=request.fields)
 
     def delete(self, uri, for_roles=[]):
         request = self.decode(uri)
         self.authorize("delete", request, for_roles)
         self.delete_resource(
-            resource=request["resource"],
-            id=request["id"])
+            resource=request.resource,
+            id=request.id,
+            commit=not self.in_transaction())
 
         return None
 
-    def create_resource(self, resource, record={}):
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Return a context manager that commits the writes done within the context at once on exit,
+        or rolls them back if an exception is raised, eg:
+            with service.transaction():
+                service.create("tag", {"name": "a"})
+                service.update("event/1", {"tag": [1, 2]})
+        Nested contexts are committed by the outermost context.
+
+        The depth of the contexts is kept by session (see `transactions_key`), so that the writes
+        of the other threads (or greenlets) of a sqla scoped session are still committed.
+        """
+        session = self.current_session()
+        session.info[transactions_key] = session.info.get(transactions_key, 0) + 1
+        try:
+            yield self
+        except BaseException:
+            session.info[transactions_key] -= 1
+            if not session.info[transactions_key]:
+                session.rollback()
+            raise
+        else:
+            session.info[transactions_key] -= 1
+            if not session.info[transactions_key]:
+                session.commit()
+
+    def create_resource(self, resource, record={}, commit=True):
         """
         Create resource and return created model.
+        The session is committed unless `commit` is False, in which case it is only flushed.
         """
-        row = self.model[resource]()
-        for field, value in record.items():
-            self.set_property(row, field, value)
+        row = self._model[resource]()
+        self.set_properties(row, record)
 
         self.session.add(row)
-        self.session.commit()
+        if commit:
+            self.session.commit()
+        else:
+            self.session.flush()  # to assign the id of the created model
         return row
 
-    def read_resource(self, resource, id=None, fields=[], filters=[], joinpaths=[], order=[], limit=None):
+    def read_resource(self, resource, id=None, fields=[], filters=[], joinpaths=[], order=[], limit=None, stream=False):
         """
         Query database and return a single or multiple record(s) or recordtuple(s).
 
@@ -298,14 +499,86 @@ class Service(object):
         up to arbitrary degree of relationship.
         Support `resource='+'`, used to return recordtuples of multiple resources according the given `joinpath`. Eg:
             /+/writing.id=1 or /+?/writing/topic
+
+        If `stream` is True, multiple records are returned as a generator that fetches
+        and serializes the results by batches, instead of a list.
+        The generator must be consumed while the session is open, eg. before it is committed or removed.
+        """
+
+        # Note: the query is built by a function specific to the shape of the request,
+        # that is created once per shape (see `query_builder()`) and given the values of the request
+        has_id = bool(id) and id not in reserved_ids
+        shape = (
+            resource,
+            has_id,
+            tuple(tuple(field) for field in fields),
+            tuple((f_resource, field, comparator) for f_resource, field, comparator, value in filters),
+            tuple(tuple((relresource, relfield, comparator, bool(value)) for relresource, relfield, comparator, value in joinpath)
+                  for joinpath in joinpaths),
+            tuple(tuple(o) for o in order))
+        values = [id] if has_id else []
+        values += [value for f_resource, field, comparator, value in filters]
+        values += [value for joinpath in joinpaths for relresource, relfield, comparator, value in joinpath if value]
+
+        # Note: baked queries are run by a plain session, not by a scoped session proxy
+        session = self.current_session()
+
+        build = self._query_builder(shape)
+
+        # Handle field ':count'
+        if build.count:
+            # Note: field :count is a virtual field that triggers the
+            # return of dict(count = the number of records matched by the given uri query).
+            return {":count": build(session, values, limit, count=True).scalar()}
+
+        query = build(session, values, limit, stream=stream)
+
+        # Serialize and return results
+        # managing `result` as sqla model instance or sqla model instance tuple
+        if build.record_fields:
+            # Note: the results are rows of the columns of the records (see `query_builder()`)
+            record_fields = build.record_fields
+            if not id or id == "+":
+                results = (dict(zip(record_fields, result)) for result in query)
+                return results if stream else list(results)
+            return dict(zip(record_fields, query.one()))
+
+        if not id or id == "+":
+            if stream:
+                return util.serialize_results(self._resource, query)
+            return list(util.serialize_results(self._resource, query))
+
+        if id or id == "-":
+            result = query.one()
+            return util.serialize_result(self._resource, result)
+
+    def query_builder(self, shape):
         """
+        Return a function `build(session, values, limit=None, count=False, stream=False)`
+        that returns the sqla baked query result for the requests of the given `shape`.
+        The function has the attributes `count` (the shape requests field ':count'),
+        `eager_collections` (the query eagerly loads ..n relationships)
+        and `record_fields` (the fields of the rows of columns returned instead of model instances, if any).
+
+        Argument `shape` is the request without its values (see `read_resource()`), eg:
+            ("event", True, ((None, "time"),), ((None, "summary", "like"),), ((("tag", "id", "eq", True),),), ())
+        Argument `values` is the list of the id (if any), filters values and joinpaths values (if any) of the request.
+        If `count` is True, the result is the number of records matched.
+        If `stream` is True, the result fetches the records by batches when possible.
+
+        The models, relations, columns and order of the given `shape` are resolved once,
+        the functions returned are cached by Service instances (see `_query_builder`).
+        The values are bound as parameters of the sqla query, so that the query and its compiled statement
+        are built once per shape and limit (see `_bakery`).
+        """
+        resource, has_id, fields, filters, joinpaths, order = shape
 
         # Create models to be queried in `session.query(models)`,
         # create base_model conditionally to be used as base model by filters and joinpaths.
         if resource in ("+", "-"):
             # Note: query on arbitrary resources based on the given joinpaths
 
-            if id and id not in reserved_ids:
+            if has_id:
                 raise ValueError(
                     f"Resource-less request with an id make little sense. Use id reserved id '+' "
                     f"and a query string filter on a specific resource id instead, eg: /+/+?/topic=1")
@@ -331,54 +604,60 @@ class Service(object):
             models = [base_model]
 
         # Create base sqla query
-        log.debug(f"Creating sqla query with models={models}")
-        query = self.session.query(*models)
-        if id and id not in reserved_ids:
-            for model in models:
-                query = query.filter(model.id == id)
+        log.debug(f"Creating sqla query builder with models={models}")
+        steps = []  # functions applied to the sqla query
+        marshals = []  # functions marshalling the values bound to the sqla query parameters, by parameter index
+        if has_id:
+            primary_key = get_primary_key(models[0])  # Note: requests with an id have a single model (see above)
+            steps.append(lambda query, clause=primary_key == sqlalchemy.bindparam("p0", type_=primary_key.type):
+                query.filter(clause))
+            marshals.append(lambda value: value)
 
         # Process and apply filters to sqla query
         for filter in filters:
-            resource, field, comparator, value = filter
+            f_resource, field, comparator = filter
 
-            if not resource:
+            if not f_resource:
                 if base_model:
-                    resource = self.resource[base_model]
+                    f_resource = resource
                 else:
                     raise ValueError(f"Filter '{filter}' is missing a resource component that is required in resourceless request, eg: resource.field.operator=1")
 
-            queryfilter = self.make_filter(resource, field, comparator, value)
-            query = query.filter(queryfilter)
+            make_filter = self.filter_maker(f_resource, field, comparator)
+            steps.append(lambda query, clause=make_filter.bound(f"p{len(marshals)}"): query.filter(clause))
+            marshals.append(make_filter.marshal)
 
         # Process and apply joinpaths to sqla query
+        joined = set()  # relationships already joined, eg. by joinpaths sharing a prefix
         for joinpath in joinpaths:
-            last_relmodel = None
-            surrogate_base_model = None
+            relations = self._relations[base_model] if base_model else None  # relations of the last joined model
 
             for joinnode in joinpath:
-                relresource, relfield, comparator, value = joinnode
+                relresource, relfield, comparator, has_value = joinnode
                 relmodel = self.model[relresource]
 
-                if value:
+                if has_value:
                     # Note: add join filter
-                    relfilter = self.make_filter(*joinnode)
-                    query = query.filter(relfilter)
+                    make_filter = self.filter_maker(relresource, relfield, comparator)
+                    steps.append(lambda query, clause=make_filter.bound(f"p{len(marshals)}"): query.filter(clause))
+                    marshals.append(make_filter.marshal)
 
-                if not base_model and not surrogate_base_model:
+                if relations is None:
                     # Note: simulate that a resource was given
                     # and that its valus is first element of the given joins path
-                    surrogate_base_model = self.model[relresource]
+                    relations = self._relations[relmodel]
                     continue
 
-                # TODO: this hook should allow the user to specify a function to generate the name
-                # of the local model column that is related to foreign model represented by relresource.
-                get_relcolumn = lambda v: v
-                relcolumn = get_relcolumn(relresource)
+                if relresource not in relations:
+                    raise ValueError(f"Joinpath node '{relresource}' is not a relation of the previous node in joinpath {joinpath}")
 
                 # Note: adds a chain of joins and filters to the current query, in order to generate this kind of query:
                 #   s.query(data.Author).join(data.Author.writing).join(data.Writing.activity).join(data.Activity.topic).filter(data.Topic.id.in_([1]))
-                joincolumn = getattr(last_relmodel or surrogate_base_model or base_model, relcolumn)  # use base_model or surrogate_base_model for first iteration
-                if resource == '+':
+                relmodel, joincolumn = relations[relresource]
+                if (joincolumn.class_, joincolumn.key) in joined:
+                    # Note: sqla would skip the join as well, with a warning
+                    pass
+                elif resource == '+':
                     # FIXME: allow to describe joinpath to use `query.outerjoin`
                     #   to include empty relationships in combinatory result, eg:
                     #   /author=25/+writing/+activity & /activity/+activity_type & /activity/topic
@@ -386,23 +665,52 @@ class Service(object):
                     #               and return joinpaths=[(type, resource, field, comparator, value)]
                     #
                     # For now, resourceless requests trigger outerjoin
-                    query = query.outerjoin(joincolumn)
+                    steps.append(lambda query, joincolumn=joincolumn: query.outerjoin(joincolumn))
                 else:
-                    query = query.join(joincolumn)
-
-                last_relmodel = self.model[relresource] # last_relmodel is used in next iteration to create the "joins chain"
-
-        # Apply limit to sqla query
-        query = query.limit(limit)
-
-        # Handle field ':count'
-        if ":count" in [field for f_resource, field in fields]:
-            # Note: field :count is a virtual field that triggers the
-            # return of dict(count = the number of records matched by the given uri query).
-            return {":count": query.count()}
+                    steps.append(lambda query, joincolumn=joincolumn: query.join(joincolumn))
+                joined.add((joincolumn.class_, joincolumn.key))
+
+                relations = self._relations[relmodel] # used in next iteration to create the "joins chain"
+
+        def initial(session):
+            query = session.query(*models)
+            for step in steps:
+                query = step(query)
+            return query
+
+        # Note: the bakery key is the code of `initial()` and the shape, with the criteria added below
+        baked = self._bakery(initial, shape)
+
+        def build(session, values, limit=None, count=False, stream=False):
+            query = baked
+            if limit:
+                query = query.with_criteria(lambda query: query.limit(limit), limit)
+            if count:
+                if limit or not base_model:
+                    query = query.with_criteria(lambda query: query.from_self(sqlalchemy.func.count(sqlalchemy.literal_column("*"))))
+                else:
+                    # Note: the rows of a single model are counted directly, instead of
+                    # wrapping the query into a subquery as `query.count()` does
+                    query = query.with_criteria(lambda query: query.with_entities(sqlalchemy.func.count(get_primary_key(base_model))))
+            elif stream and not build.eager_collections:
+                # Note: sqla cannot fetch by batches the results that eagerly load ..n relationships
+                query = query.with_criteria(lambda query: query.yield_per(200))
+            return query(session).params({f"p{i}": marshal(value) for i, (marshal, value) in enumerate(zip(marshals, values))})
+
+        # Note: the fields are partitioned once per shape into the count, the columns and the relationships to load,
+        # which `read_resource()` reads from the attributes of the returned function
+        build.count = any(f_field == ":count" for f_resource, f_field in fields)
+        build.eager_collections = False
+        build.record_fields = None
+
+        # Handle field ':count', the query is counted as is (see `read_resource()`)
+        if build.count:
+            return build
 
         # Apply order to sqla query
-        order = order + self.default_order.get(resource, [])
+        # Note: `default_order` is read once per shape
+        order = list(order) + self.default_order.get(resource, [])
+        clauses = []
         for o_resource, o_field, o_direction in order:
 
             if o_resource:
@@ -410,12 +718,14 @@ class Service(object):
             else:
                 o_model = base_model
 
-            query = query.order_by(getattr(getattr(o_model, o_field), o_direction)())
+            clauses.append(getattr(getattr(o_model, o_field), o_direction)())
             # FIXME: handle lowercase ordering:
             # column = getattr(model, o_field)
             # modifier = sqlalchemy.func.lower
             # direction = getattr(sqlalchemy.func, o_direction)
             # query = query.order_by(direction(column))
+        if clauses:
+            steps.append(lambda query: query.order_by(*clauses))
 
         # Process and apply fields to sqla query
         if resource in ["+", "-"]:
@@ -425,29 +735,25 @@ class Service(object):
             entities = []
             if not fields:
                 # if no field is given, all the fields of the computed `models` are included.
-                entities = [
-                    getattr(m, attr.key).label(f"{self.resource[m]}.{attr.key}")
-                    for m in models for attr in m._sa_class_manager.attributes
-                    if not util.is_relationship(getattr(m, attr.key))]
+                entities = [entity for m in models for entity in self._labeled_columns[m].values()]
             else:
                 for f_resource, f_field in fields:
                     if f_resource:
                         f_model = self.model[f_resource]
-                        if not util.is_relationship(getattr(f_model, f_field)):
-                            entities.append(getattr(f_model, f_field).label(f"{f_resource}.{f_field}"))
+                        if f_field in self._labeled_columns[f_model]:
+                            entities.append(self._labeled_columns[f_model][f_field])
+                        else:
+                            getattr(f_model, f_field)  # raise AttributeError if the field does not exist, relationships are skipped
                     else:
                         # If a field does not describe a resource, the given field is loaded for all the computed `models`.
-                        f_models = [
-                            m for m in models
-                            if hasattr(m, f_field)
-                            and not util.is_relationship(getattr(m, f_field))]
-
-                        for f_model in f_models:
-                            entities.append(getattr(f_model, f_field).label(f"{self.resource[f_model]}.{f_field}"))
+                        entities += [self._labeled_columns[m][f_field] for m in models if f_field in self._labeled_columns[m]]
 
-            query = query.with_entities(*[entity for entity in entities])
+            steps.append(lambda query: query.with_entities(*entities))
 
         else:
+            # Note: fields are grouped by model, so that a single load_only() option is applied per model
+            load_only = defaultdict(list)  # model -> loaded fields
+            options = []
             for f_resource, f_field in fields:
 
                 if f_resource:
@@ -457,54 +763,77 @@ class Service(object):
 
                 # apply field selection to sqla query select statement,
                 # see https://docs.sqlalchemy.org/en/latest/orm/loading_columns.html
-                try:
+                column, kind = self.column(f_model, f_field)
+                if not util.is_relationship(column):
                     # field is a property
-                    query = query.options(sqlalchemy.orm.Load(f_model).load_only(f_field))
+                    load_only[f_model].append(f_field)
 
-                except sqlalchemy.orm.exc.LoaderStrategyException:
+                else:
                     # field is a relationship
-                    column = getattr(f_model, f_field)
-                    query = query.options(sqlalchemy.orm.joinedload(column).load_only("id"))  # hardcode to foreign field "id"
-                    query = query.options(sqlalchemy.orm.Load(f_model).load_only("id"))  # to ensure limiting local fields, we set option load_only on local primary key (which is always loaded in anyway)
+                    build.eager_collections = build.eager_collections or kind == "collection"
+                    options.append(sqlalchemy.orm.joinedload(column).load_only(get_primary_key(column.property.mapper.class_).key))  # foreign primary key
+                    load_only[f_model].append(get_primary_key(f_model).key)  # to ensure limiting local fields, we set option load_only on local primary key (which is always loaded in anyway)
+
+            # Note: the records of a single model that load no relationship are selected as rows of columns,
+            # which skips the creation of the model instances (see `read_resource()`)
+            mapper = sqlalchemy.inspect(base_model)
+            if not options and set(load_only) <= {base_model} and not any(
+                    relationship.lazy in ("joined", "subquery", "selectin", "immediate") for relationship in mapper.relationships):
+                if fields:
+                    loaded = {*load_only[base_model], *(mapper.get_property_by_column(column).key for column in mapper.primary_key)}
+                else:
+                    loaded = {column_attr.key for column_attr in mapper.column_attrs if not column_attr.deferred}
+                build.record_fields = tuple(field for field in util.get_model_fields(base_model)[0] if field in loaded)  # in the order of `util.serialize_model()`
+                entities = [getattr(base_model, field) for field in build.record_fields]
+                steps.append(lambda query: query.with_entities(*entities))
+                return build
 
-        # Serialize and return results
-        # managing `result` as sqla model instance or sqla model instance tuple
-        if not id or id == "+":
-            results = query.all()
-            return [util.serialize_result(self.resource, result) for result in results]
+            options += [sqlalchemy.orm.Load(f_model).load_only(*dict.fromkeys(f_fields)) for f_model, f_fields in load_only.items()]
+            if options:
+                steps.append(lambda query: query.options(*options))
 
-        if id or id == "-":
-            result = query.one()
-            return util.serialize_result(self.resource, result)
+        return build
 
-    def update_resource(self, resource, id, record):
+    def update_resource(self, resource, id, record, commit=True):
         """
         Update database accoring the given `resource`, `id` and `record`.
+        The session is committed unless `commit` is False.
         """
         if not id or id in reserved_ids:
             # TODO: update using filters and reserved_ids features is not yet implemented
             raise ValueError(f"Missing id in URI, or invalid id format: '{id}'")
 
-        query = self.session.query(self.model[resource])
-        if id: query = query.filter_by(id=id)
-        row = query.one()
-        for field, value in record.items():
-            self.set_property(row, field, value)
+        self.set_properties(self.get_row(resource, id), record)
 
-        self.session.commit()
+        if commit:
+            self.session.commit()
 
-    def delete_resource(self, resource, id):
+    def delete_resource(self, resource, id, commit=True):
         """
         Delete from database accoring the given `resource` and `id`.
+        The session is committed unless `commit` is False.
         """
         if not id or id in reserved_ids:
             # TODO: update using filters and reserved_ids features is not yet implemented
             raise ValueError(f"Missing id in URI, or invalid id format: '{id}'")
 
-        query = self.session.query(self.model[resource])
-        query = query.filter_by(id=id)
-        self.session.delete(query.one())
-        self.session.commit()
+        self.session.delete(self.get_row(resource, id))
+        if commit:
+            self.session.commit()
+
+    def get_row(self, resource, id):
+        """
+        Return the row of the given `resource` whose primary key is the given `id`,
+        marshalled according the primary key type (eg. ValueError for id 'abc' of an integer key).
+        Raise NoResultFound if there is no such row.
+        """
+        # Note: query.get() looks up the identity map first, so that a record already loaded
+        # (eg. read or written earlier in the same transaction) does not need a roundtrip
+        model = self._model[resource]
+        row = self.session.query(model).get(get_cast(type(get_primary_key(model).type))(id))
+        if row is None:
+            raise sqlalchemy.orm.exc.NoResultFound(f"No row was found for {resource} id {id}")
+        return row
 
     # def get_field(self, column):
     #     """
@@ -514,47 +843,61 @@ class Service(object):
     #     raise NotImplementedError('Not yet needed')
 
 
+    def column(self, model, field):
+        """
+        Return the sqla column of the given `model` and `field`, and its kind (see `column_kind()`).
+        Raise AttributeError if the model has no such field.
+        """
+        try:
+            return self._columns[self._resource.get(model), field]
+        except KeyError:
+            column = getattr(model, field)
+            return column, column_kind(column)
+
     def make_filter(self, resource, field, comparator, value):
         """
         Return a sqla filter object, according the given `field`, `comparator` and `value`.
         Used by rest api to apply filters specified as string in url.
-        Comparator is a string containing a conventional value, see the code below.
+        Comparator is a string containing a conventional value, see `comparators`.
+        The value of comparators 'in' and 'notin' is a comma separated string or a list.
         """
-        column = getattr(self.model[resource], field)
+        return self.filter_maker(resource, field, comparator)(value)
+
+    def filter_maker(self, resource, field, comparator):
+        """
+        Return a function that returns the sqla filter object for a given value,
+        according the given `field` and `comparator` (see `make_filter()`).
+        The column, comparator and cast are resolved once, eg. by `query_builder()`.
+
+        The function has the attributes `bound(key)`, that returns the sqla filter object
+        for a value bound to the sqla parameter `key`, and `marshal(value)`, that returns the value to bind.
+        """
+        column, kind = self.column(self.model[resource], field)
+
+        if comparator not in comparators:
+            raise KeyError(f'Comparator not supported: {comparator}')
+        compare = comparators[comparator]
 
         # Marshal value according the comparator
         if comparator in ('in', 'notin'):
-            value = str(value).split(',') if value else []
+            # Note: the list is bound as a single parameter that is expanded at execution time,
+            # so that the sql statement text does not depend on the number of values
+            # (which keeps it stable for the compiled statements and dbapi prepared statements caches)
+            # Note: a value that is already a list (eg. given to `make_filter()` by code) is bound as is,
+            # a value from an uri is split once
+            marshal = lambda value: list(value) if isinstance(value, (list, tuple)) else str(value).split(',') if value else []
+            make_filter = lambda value: compare(column, sqlalchemy.bindparam(None, marshal(value), expanding=True))
+            make_filter.bound = lambda key: compare(column, sqlalchemy.bindparam(key, expanding=True))
         else:
             # marshal value according the column type
-            cast = {
-                sqlalchemy.sql.sqltypes.Integer: lambda value: int(value),
-                sqlalchemy.sql.sqltypes.Boolean: lambda value: True if not value.isnumeric() else bool(int(value))}
-            value = cast.get(type(column.type), lambda value: value)(value)
-
-        # Handle comparator
-        if comparator == 'eq':
-            return column == value
-        if comparator == 'ne':
-            return column != value
-        if comparator == 'lt':
-            return column < value
-        if comparator == 'le':
-            return column <= value
-        if comparator == 'gt':
-            return column > value
-        if comparator == 'ge':
-            return column >= value
-        elif comparator == 'like':
-            return getattr(column, 'like')(value)
-        elif comparator == 'ilike':
-            return getattr(column, 'like')(value)
-        elif comparator == 'in':
-            return getattr(column, 'in_')(value)
-        elif comparator == 'notin':
-            return getattr(column, 'notin_')(value)
-        else:
-            raise KeyError(f'Comparator not supported: {comparator}')
+            marshal = get_cast(type(column.type))
+            make_filter = lambda value: compare(column, marshal(value))
+            # Note: the parameter is bound with the type sqla gives to a marshalled value compared to the column,
+            # eg. a string compared to a sqlite datetime column stays a string (as when the value is given inline)
+            bound_type = compare(column, marshal("1")).right.type
+            make_filter.bound = lambda key: compare(column, sqlalchemy.bindparam(key, type_=bound_type))
+        make_filter.marshal = marshal
+        return make_filter
 
 
     def set_property(self, model_instance, property_name, value):
@@ -562,36 +905,63 @@ class Service(object):
         Set the given `value` on the `property` of the given `model`, handling
         ..n and ..1 relationships by setting models instance(s) accordingly.
         """
-        column = getattr(model_instance.__class__, property_name)
+        self.set_properties(model_instance, {property_name: value})
 
-        if type(column.impl) == sqlalchemy.orm.attributes.ScalarAttributeImpl:
-            # column is a scalar
-            try:
-                setattr(model_instance, property_name, value)
-            except Exception as e:
-                raise ValueError(
-                    f"Cannot set property {property_name}={value} to model '{model_instance.__class__.__name__}': "
-                    f"{e.__class__.__name__}: {e}")
+    def set_properties(self, model_instance, record):
+        """
+        Set the values of the given `record` on the properties of the given `model`,
+        handling ..n and ..1 relationships by setting models instance(s) accordingly.
+        The relations are loaded in one query per relation model, whatever the number of fields.
+        """
+        collections = {}  # property name -> relation ids
+        scalars = {}  # property name -> relation id
+        for property_name, value in record.items():
+            column, kind = self.column(model_instance.__class__, property_name)
 
-        elif util.is_relationship(column):
-            relation = self.model[property_name]
-            relation_id = getattr(relation, "id")
+            if kind == "scalar":
+                # column is a scalar
+                try:
+                    setattr(model_instance, property_name, value)
+                except Exception as e:
+                    raise ValueError(
+                        f"Cannot set property {property_name}={value} to model '{model_instance.__class__.__name__}': "
+                        f"{e.__class__.__name__}: {e}")
 
-            if isinstance(column.impl, sqlalchemy.orm.attributes.ScalarObjectAttributeImpl):
+            elif kind == "relationship":
                 # column is a 1.. relationship
-                relation = self.session.query(relation).filter(relation_id == value)
-                setattr(model_instance, property_name, relation.one() if value else None)
+                scalars[property_name] = value
 
-            elif isinstance(column.impl, sqlalchemy.orm.attributes.CollectionAttributeImpl):
+            elif kind == "collection":
                 # column is a n.. relationship
-                relations = self.session.query(relation).filter(relation_id.in_(value))
-                setattr(model_instance, property_name, relations.all())
+                collections[property_name] = value
                 # TODO: allow to add and remove relations one by one, eg:
                 # relation: ["+1", "-2"]        <-- add relation id 1, remove relation id 2
                 # relation: ["+1", "-2", 3, 4]  <-- resets all relations to ids [3, 4] and do same as above
                 # use column.add() and column.remove()
-            else:
+
+            elif util.is_relationship(column):
                 raise NotImplementedError("Column relationship impl not supported: {column.impl}")
 
-        else:
-            raise NotImplementedError("Column impl not supported: {column.impl}")
+            else:
+                raise NotImplementedError("Column impl not supported: {column.impl}")
+
+        # Load the n.. relations with one query per relation model
+        ids = defaultdict(set)  # relation model -> relation ids
+        for property_name, value in collections.items():
+            relation = self._model[property_name]
+            cast = get_cast(type(get_primary_key(relation).type))
+            collections[property_name] = [cast(id) for id in value]
+            ids[relation].update(collections[property_name])
+        loaded = {}  # relation model -> relation id -> relation
+        for relation, relation_ids in ids.items():
+            primary_key = get_primary_key(relation)
+            rows = self.session.query(relation).filter(primary_key.in_(relation_ids))
+            loaded[relation] = {getattr(row, primary_key.key): row for row in rows}
+        for property_name, value in collections.items():
+            rows = loaded[self._model[property_name]]
+            setattr(model_instance, property_name, [rows[id] for id in dict.fromkeys(value) if id in rows])
+
+        # Note: `get_row()` looks up the identity map first, so that the 1.. relations
+        # already loaded (eg. above) do not need a roundtrip
+        for property_name, value in scalars.items():
+            setattr(model_instance, property_name, self.get_row(property_name, value) if value else None)
@@ -7,28 +7,60 @@ General utility functions for the framework.
 
 from . import uri
 
+from collections import defaultdict
 import sqlalchemy
+from sqlalchemy.ext.declarative.api import DeclarativeMeta
+from sqlalchemy.orm.attributes import instance_state
+from sqlalchemy.orm.relationships import RelationshipProperty
+import weakref
+
+# Models found by `models_from()`, by module
+module_models = weakref.WeakKeyDictionary()
 
 def models_from(module):
     """
     Return a dict of sqla models from the given `module`.
     The given module is iterated to extract its sqla models. Each sqla model is
     mapped to a resource name = modelname.lower().
+
+    The models are found once per module, unless the module models are replaced (eg. reloaded).
     """
-    return {model.__name__.lower(): model for model in vars(module).values() if is_model(model)}
+    attributes = vars(module)
+    models = module_models.get(module)
+    if models is None or any(attributes.get(model.__name__) is not model for model in models.values()):
+        models = {model.__name__.lower(): model for model in attributes.values() if is_model(model)}
+        module_models[module] = models
+    return dict(models)
+
+# Answers of `is_model()` for classes, and of `is_relationship()` by property class
+model_classes = weakref.WeakKeyDictionary()
+relationship_classes = {}
 
 def is_model(thing):
     """
     Return True if `thing` is a sqla model class.
+    The answer is cached for classes, eg. when serializing `type(result)` for each result.
     """
-    return (isinstance(thing, sqlalchemy.ext.declarative.api.DeclarativeMeta)
+    if not isinstance(thing, type):
+        return False
+    try:
+        return model_classes[thing]
+    except KeyError:
+        model_classes[thing] = answer = (
+            isinstance(thing, DeclarativeMeta)
             and hasattr(thing, '__table__'))  # disard sqlalchemy.ext.declarative.declarative_base()
+        return answer
 
 def is_relationship(column):
     """
     Return True is the given sqla `column` is a relationship.
     """
-    return isinstance(column.property, sqlalchemy.orm.relationships.RelationshipProperty)
+    property_class = type(column.property)
+    try:
+        return relationship_classes[property_class]
+    except KeyError:
+        relationship_classes[property_class] = answer = issubclass(property_class, RelationshipProperty)
+        return answer
 
 def serialize_result(service_resource_map, result_or_resulttuple):
     """
@@ -64,18 +96,76 @@ def serialize_result(service_resource_map, result_or_resulttuple):
 
     return serialized
 
+def serialize_results(service_resource_map, results):
+    """
+    Return a generator of the serialized `results`, a list or an iterator of
+    sqla model instances or sqla result tuples (see `serialize_result()`).
+
+    The serializer is chosen once per type of result, instead of once per result:
+    the results of a query share their type, and the result tuples share their keys (see `tuple_serializer()`).
+    """
+    serializers = {}
+    for result in results:
+        try:
+            serialize = serializers[type(result)]
+        except KeyError:
+            serialize = serializers[type(result)] = serialize_model if is_model(type(result)) else tuple_serializer(result._fields)
+        yield serialize(result)
+
+def tuple_serializer(keys):
+    """
+    Return a function that serializes the sqla result tuples having the given `keys`
+    as `serialize_tuple()` does, the keys being split once for all the results.
+    """
+    resource_fields = [tuple_keys.get(key) or tuple_keys.setdefault(key, tuple(key.split('.'))) for key in keys]
+    resources = list(dict.fromkeys(resource for resource, field in resource_fields))
+
+    def serialize(result):
+        serialized = {resource: {} for resource in resources}
+        for (resource, field), value in zip(resource_fields, result):
+            serialized[resource][field] = value
+        return serialized
+
+    return serialize
+
 def serialize_tuple(result):
     """
     Return a json encodable dict of the `sqlalchemy.util._collections.result` given as `result`,
     containing a key per resource containing a dict of key per field containing the field value.
     The collection keys must be formatted as 'resource.field'.
     """
-    serialized = {}
-    for key, value in result._asdict().items():
-        resource, field = key.split('.')
-        serialized[resource] = dict(**{field: value}, **serialized.get(resource, {}))
+    serialized = defaultdict(dict)
+    for key, value in zip(result._fields, result):
+        try:
+            resource, field = tuple_keys[key]
+        except KeyError:
+            resource, field = tuple_keys.setdefault(key, tuple(key.split('.')))
+        serialized[resource][field] = value
 
-    return serialized
+    return dict(serialized)
+
+# Keys of the tuples serialized by `serialize_tuple()`, split into (resource, field)
+tuple_keys = {}
+
+# Fields and relationship fields of the models serialized by `serialize_model()`, by model
+model_fields = weakref.WeakKeyDictionary()
+
+def get_model_fields(model):
+    """
+    Return a tuple of (fields, relationship_fields) of the given sqla `model`, computed once per model.
+    The relationship fields is a dict of relationship field -> (uselist, primary_key), where `uselist`
+    is True if the relationship is ..n and `primary_key` is the primary key field of the related model
+    (its first primary key column), eg. {"tag": (True, "id")}.
+    """
+    try:
+        return model_fields[model]
+    except KeyError:
+        mapper = sqlalchemy.inspect(model)
+        fields = (tuple(mapper.class_manager.keys()), {
+            relationship.key: (relationship.uselist, relationship.mapper.get_property_by_column(relationship.mapper.primary_key[0]).key)
+            for relationship in mapper.relationships})
+        model_fields[model] = fields
+        return fields
 
 def serialize_model(result):
     """
@@ -83,33 +173,35 @@ def serialize_model(result):
     """
     relation_prefix = '/'  # this prefix is added to fields that are a relation
 
-    # Note: unloaded property is used to discard fields that are not loaded, ie. lazily loaded,
-    # such as relationships (by default), and fields not specified in query select clause.
-    selected = (lambda field: not field in sqlalchemy.orm.attributes.instance_state(result).unloaded)
-    fields = list(filter(selected, result._sa_instance_state.attrs.keys()))
+    # Note: the values are read from the instance state dict, that contains the loaded fields only:
+    # fields that are not loaded, ie. lazily loaded, such as relationships (by default),
+    # and fields not specified in query select clause, are discarded without triggering their load.
+    # The fields and relationships are computed once per model.
+    values = instance_state(result).dict
+    fields, relationships = get_model_fields(type(result))
 
     object = {}
     for field in fields:
 
-        try:
-            value = getattr(result, field)
-        except AttributeError:
-            continue  # we are permissive
+        if field not in values:
+            continue
 
-        if not is_relationship(getattr(result.__class__, field)):
+        value = values[field]
+        if field not in relationships:
             object[field] = value
+            continue
 
-        else:
-            if isinstance(value, sqlalchemy.orm.collections.InstrumentedList):
-                # ..n relationship: value is a list of sqla models
-                object[relation_prefix + field] = list(map(lambda result: result.id, value))
+        uselist, primary_key = relationships[field]
+        if uselist:
+            # ..n relationship: value is a list of sqla models
+            object[relation_prefix + field] = [getattr(relation, primary_key) for relation in value]
 
-            elif isinstance(type(value), sqlalchemy.ext.declarative.api.DeclarativeMeta):
-                # ..1 relationship: value is a sqla model
-                object[relation_prefix + field] = value.id
+        elif value is not None:
+            # ..1 relationship: value is a sqla model
+            object[relation_prefix + field] = getattr(value, primary_key)
 
-            else:
-                # ..1 relationship: value shall be empty
-                object[relation_prefix + field] = value
+        else:
+            # ..1 relationship: value shall be empty
+            object[relation_prefix + field] = value
 
     return object
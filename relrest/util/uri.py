@@ -28,8 +28,32 @@ TODO: provide with the equivalent in language javascript for easy URI generation
 
 """
 
+import collections
+import sys
 import urllib
 
+class Request(collections.namedtuple("Request", ["resource", "id", "fields", "joinpaths", "filters", "order", "limit"])):
+    """
+    The relrest-request returned by `decode()`, immutable and hashable
+    (its fields, filters, joinpaths and order are tuples), eg:
+        Request(resource='event', id='', fields=(), joinpaths=((('tag', 'id', 'eq', '1'),),), filters=(), order=(), limit=None)
+
+    Its components are read as attributes, eg. `request.fields`, or as a mapping, eg. `request["fields"]`,
+    so that `encode(**decode(uri))` and `dict(request)` work. Use `request._replace()` to derive a modified request.
+    """
+    __slots__ = ()
+
+    def keys(self):
+        return self._fields
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return super().__getitem__(key)
+
 def encode(resource, id=None, fields=[], joinpaths={}, filters={}, limit=None, order=[]):
     """
     Return an uri from the given `resource_id_field` and `query` object.
@@ -38,8 +62,8 @@ def encode(resource, id=None, fields=[], joinpaths={}, filters={}, limit=None, o
     """
     # FIXME: what to do when no `id` is given ? for now it crashes
 
-    if isinstance(resource, dict):
-        raise ValueError(f"Argument 'resource' must be a str, not a dict. Did you do mean 'uri.encode(**uri.decode(...))' ?")
+    if isinstance(resource, (dict, Request)):
+        raise ValueError(f"Argument 'resource' must be a str, not a request. Did you do mean 'uri.encode(**uri.decode(...))' ?")
 
     # Build uri `path` component, setting `fields_rf` to be eg: ['field'] or ['resource.field']
     fields_rf = [
@@ -49,8 +73,11 @@ def encode(resource, id=None, fields=[], joinpaths={}, filters={}, limit=None, o
     path = '/'.join([resource, id, fields]).rstrip('/')
 
     # Build uri `query` string component (removing duplicate declarations for the filters, joinpaths and order)
-    filters = set(f"{resource}.{field}.{comparator}={value}" for resource, field, comparator, value in filters)
-    joinpaths = set(''.join([f"/{resource}.{field}.{comparator}={value}" for resource, field, comparator, value in joinpath]) for joinpath in joinpaths)
+    # Note: duplicates are removed from the decoded tuples before formatting, in order
+    filters = dict.fromkeys(tuple(filter) for filter in filters)
+    joinpaths = dict.fromkeys(tuple(tuple(joinnode) for joinnode in joinpath) for joinpath in joinpaths)
+    filters = [f"{resource}.{field}.{comparator}={value}" for resource, field, comparator, value in filters]
+    joinpaths = [''.join([f"/{resource}.{field}.{comparator}={value}" for resource, field, comparator, value in joinpath]) for joinpath in joinpaths]
     order = ','.join([f"{resource}.{field}:{direction}" if resource else f"{field}:{direction}" for resource, field, direction in order])  # order_rfd is [resource[.field[:direction]]]
 
     query = '&'.join([
@@ -69,7 +96,7 @@ def encode(resource, id=None, fields=[], joinpaths={}, filters={}, limit=None, o
 
 def decode(uri, default_resource=None, default_field='id', default_comparator='eq', default_direction='asc'):
     """
-    Return an object containing the serialized respresentation of the given uri.
+    Return a `Request` containing the serialized respresentation of the given uri.
 
     We call this object a 'relrest-request' and it is a central part of the framework,
     see the docstring of the `relrest` module.
@@ -90,7 +117,9 @@ def decode(uri, default_resource=None, default_field='id', default_comparator='e
             resource = unique list of all resources describes in all joinpaths
             (actually, it's reverse: + returns more resources than -, but for now + is implemented to return less...)
     """
-    parsed_uri = urllib.parse.urlparse(uri)
+    # Note: the uri is split by hand, since its grammar is much simpler than the one
+    # handled by `urllib.parse.urlparse()` and `urllib.parse.parse_qsl()`
+    PATH, _, QUERY_STRING = uri.partition('#')[0].partition('?')
 
     fields = []
     joinpaths = []
@@ -99,22 +128,26 @@ def decode(uri, default_resource=None, default_field='id', default_comparator='e
     order = []
 
     # Extract resource, id and fields from uri path; path is formatted as [resource[/id[/fields]]]
-    path = parsed_uri.path.strip('/').split('/')
-    path = [*path, *[''] * (3-len(path))]  # pad splitted path to ensure a list of length 3
-    try:
-        RESOURCE, ID, FIELDS_CSV = path  # all caps variables mean: pristine from the given `uri`
-        QUERY = {}
-        for arg, value in urllib.parse.parse_qsl(parsed_uri.query, keep_blank_values=True):
-            if arg.startswith('/'):
-                # a joinpath can contain sign equal (=) so we join the value into the arg
-                arg = '='.join((arg, value))
-                value = ''
-            QUERY[arg] = value
-
-    except ValueError:
+    # Note: the missing components are empty strings, as partitioning returns
+    RESOURCE, _, ID_FIELDS = PATH.strip('/').partition('/')  # all caps variables mean: pristine from the given `uri`
+    ID, _, FIELDS_CSV = ID_FIELDS.partition('/')
+    if '/' in FIELDS_CSV:
         raise ValueError(
             f"URI '{uri}' contains too many components."
             f"URI path must contain at most 3 components, eg. /resource/id/fields")
+    RESOURCE = sys.intern(RESOURCE)
+
+    QUERY = {}
+    for pair in QUERY_STRING.split('&'):
+        if not pair:
+            continue
+        arg, _, value = pair.partition('=')
+        arg, value = unquote(arg), unquote(value)
+        if arg.startswith('/'):
+            # a joinpath can contain sign equal (=) so we join the value into the arg
+            arg = '='.join((arg, value))
+            value = ''
+        QUERY[arg] = value
 
     # Extract fields
     for rf in filter(len, FIELDS_CSV.split(',')):
@@ -131,14 +164,14 @@ def decode(uri, default_resource=None, default_field='id', default_comparator='e
 
             for joinpath_node in joinpath:
                 # a node of the joinpath is formatted as: [resource[.field[.comparator]]][=value]]
-                rfc, joinpath_node_value = [*joinpath_node.split('='), *['']][:2]  # pad splitted list with value '' to length 2
+                rfc, _, joinpath_node_value = joinpath_node.partition('=')  # value is '' if not given
                 joinpath_node_rfc = joinpath_node__resource_field_comparator(
                     rfc, default_resource, default_field, default_comparator)  # a tuple, eg. ('resource', 'field', 'comparator')
                 joinpath_node = (*joinpath_node_rfc, joinpath_node_value)  # a tuple, eg. ('resource', 'field', 'comparator', 'value')
 
                 joinpath_nodes.append(joinpath_node)
 
-            joinpaths.append(joinpath_nodes)  # a list of tuples
+            joinpaths.append(tuple(joinpath_nodes))  # a tuple of tuples
 
         # Extract limit
         elif arg == '_limit':
@@ -159,21 +192,21 @@ def decode(uri, default_resource=None, default_field='id', default_comparator='e
                     field = order_fd
                     direction = default_direction
 
-                order.append([resource, field, direction])
+                order.append((intern(resource), intern(field), direction))
 
         else:
             # query `arg`: is a filter: a rfc description formatted as: [[resource.]field[.comparator]][=value]]
             filter_rfc = filter__resource_field_comparator(arg, default_resource, default_field, default_comparator)
             filters.append((*filter_rfc, value))  # a tuple, eg. ('resource', 'field', 'value')
 
-    return {
-        'resource': RESOURCE,
-        'id': ID,
-        'fields': fields,
-        'joinpaths': joinpaths,
-        'filters': filters,
-        'order': order,
-        'limit': limit}
+    return Request(
+        resource=RESOURCE,
+        id=ID,
+        fields=tuple(fields),
+        joinpaths=tuple(joinpaths),
+        filters=tuple(filters),
+        order=tuple(order),
+        limit=limit)
 
 
 def field__resource_field(rf_description, default_resource):
@@ -189,21 +222,19 @@ def field__resource_field(rf_description, default_resource):
     if not rf_description:
         raise('Field description cannot parsed when be empty: it makes no sense')
 
-    rf = rf_description.split('.')
+    rf = rf_description.split('.', 2)  # Note: at most 3 components are split, 3 is already too many
     resource = field = None
     try:
         resource, field = rf
     except ValueError:
         if len(rf) > 2:
-            raise ValueError(f"Field '{field}' must contain at most 2 components, eg: resource.field")
+            raise ValueError(f"Field '{rf_description}' must contain at most 2 components, eg: resource.field")
         try:
             field = rf.pop()
         except IndexError:
             raise ValueError(f"Field '{field}' must contain at least 1 components, eg: resource.field.comparator")
 
-    resource, field = [resource or default_resource, field]
-
-    return resource, field
+    return intern(resource or default_resource), intern(field)
 
 def joinpath_node__resource_field_comparator(rfc_description, default_resource, default_field, default_comparator):
     """
@@ -216,19 +247,13 @@ def joinpath_node__resource_field_comparator(rfc_description, default_resource,
         'resource.field' -> (resource, field, default_comparator)
         'resource.field.comparator' -> (resource, field, comparator)
     """
-    rfc = resource_field_comparator = rfc_description.split('.')
-    try:
-        rfc = [*rfc, *[''] * (3-len(rfc))]  # pad to ensure a list of length 3
-    except ValueError:
-        raise ValueError(f"Filter '{description}' must contain at most 3 components, eg: resource.field.comparator")
-
-    resource, field, comparator = rfc
-    resource, field, comparator = [
-        resource or default_resource,
-        field or default_field,
-        comparator or default_comparator]
+    # Note: the missing components are empty strings, as partitioning returns
+    resource, _, field_comparator = rfc_description.partition('.')
+    field, _, comparator = field_comparator.partition('.')
+    if '.' in comparator:
+        raise ValueError(f"Joinpath node '{rfc_description}' must contain at most 3 components, eg: resource.field.comparator")
 
-    return (resource, field, comparator)
+    return (intern(resource or default_resource), intern(field or default_field), comparator or default_comparator)
 
 def filter__resource_field_comparator(rfc_description, default_resource, default_field, default_comparator):
     """
@@ -241,25 +266,37 @@ def filter__resource_field_comparator(rfc_description, default_resource, default
         'field.comparator' -> (default_resource, field, default)
         'resource.field.comparator' -> (resource, field, default)
     """
-    rfc = resource_field_comparator = rfc_description.split('.')
+    rfc = resource_field_comparator = rfc_description.split('.', 3)  # Note: at most 4 components are split, 4 is already too many
 
+    # Note: the number of components is checked explicitly, a split always returns at least 1 component
     resource = field = comparator = None
-    try:
+    if len(rfc) > 3:
+        raise ValueError(f"Filter '{rfc_description}' must contain at most 3 components, eg: resource.field.comparator")
+    elif len(rfc) == 3:
         resource, field, comparator = rfc
-    except ValueError:
-        try:
-            if len(rfc) > 3:
-                raise ValueError(f"Filter '{description}' must at most 3 components, eg: resource.field.comparator")
-            field, comparator = rfc
-        except ValueError:
-            try:
-                field = rfc.pop()
-            except IndexError:
-                raise ValueError(f"Filter '{description}' must contain at least 1 component, eg: field")
+    elif len(rfc) == 2:
+        field, comparator = rfc
+    else:
+        field, = rfc
+
+    return (intern(resource or default_resource), intern(field or default_field), comparator or default_comparator)
 
-    resource, field, comparator = [
-        resource or default_resource,
-        field or default_field,
-        comparator or default_comparator]
+def unquote(string):
+    """
+    Return the given query string component `string` unquoted as `urllib.parse.parse_qsl()` does,
+    ie. with plus signs replaced by spaces and percent escapes decoded.
+    The string is returned as is when it contains neither.
+    """
+    if '+' in string:
+        string = string.replace('+', ' ')
+    if '%' in string:
+        string = urllib.parse.unquote(string)
+    return string
 
-    return (resource, field, comparator)
+def intern(string):
+    """
+    Return the given resource or field `string` interned (see `sys.intern()`),
+    so that the dict lookups by resource and field compare strings by identity.
+    Return the given `string` as is if it is not a string, eg. None.
+    """
+    return sys.intern(string) if type(string) is str else string
@@ -0,0 +1,46 @@
+"""
+Fixtures of the relrest tests: the example models with a small fixed dataset.
+"""
+
+import datetime
+import os
+import sys
+
+import pytest
+import sqlalchemy
+from sqlalchemy import orm
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "example"))  # for the example models
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import data
+import relrest
+
+@pytest.fixture
+def engine(tmp_path):
+    """
+    Return a sqla engine on a sqlite file populated with the fixed dataset below:
+    a file rather than an in-memory database, so that several sessions see the same data.
+    """
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'test.sqlite'}")
+    data.Base.metadata.create_all(engine)
+
+    session = orm.sessionmaker(bind=engine)()
+    types = [data.Type(id=1, name="meeting"), data.Type(id=2, name="call")]
+    tags = [data.Tag(id=1, name="work", color="red"), data.Tag(id=2, name="home"), data.Tag(id=3, name="misc", tag_id=1)]
+    session.add_all([
+        data.Event(id=1, summary="a", time=datetime.datetime(2000, 1, 1), tag=[tags[0], tags[1]], type=[types[0]]),
+        data.Event(id=2, summary="b", time=datetime.datetime(2001, 1, 1), tag=[tags[0]], type=[types[1]]),
+        data.Event(id=3, summary="c", time=datetime.datetime(2002, 1, 1), tag=[tags[1]], type=[types[0]]),
+        data.Event(id=4, summary="d", time=datetime.datetime(2003, 1, 1)),
+        tags[2]])
+    session.commit()
+    session.close()
+    return engine
+
+@pytest.fixture
+def service(engine):
+    """
+    Return a relrest service on a session of the fixed dataset.
+    """
+    return relrest.Service(orm.sessionmaker(bind=engine)(), relrest.util.models_from(data))
@@ -0,0 +1,86 @@
+"""
+Tests of the example flask app resource interface.
+"""
+
+import base64
+
+import pytest
+import werkzeug.test
+
+pytest.importorskip("flask_sqlalchemy")
+pytest.importorskip("orjson")
+
+admin = {"Authorization": "Basic " + base64.b64encode(b"admin:password").decode()}
+
+@pytest.fixture
+def app(engine):
+    """
+    Return the example flask app, using the database of the fixed dataset.
+    """
+    import app
+    app.app.config["SQLALCHEMY_DATABASE_URI"] = engine.url  # Note: flask_sqlalchemy reconnects when the uri changes
+    yield app
+    app.db.session.remove()
+
+@pytest.fixture
+def client(app):
+    return app.app.test_client()
+
+def test_etag(client):
+    response = client.get("/resource/event/1/summary", headers=admin)
+    assert response.status_code == 200
+    assert response.get_json() == {"id": 1, "summary": "a"}
+    etag = response.headers["ETag"]
+
+    response = client.get("/resource/event/1/summary", headers=dict(admin, **{"If-None-Match": etag}))
+    assert response.status_code == 304
+    assert response.get_data() == b""
+
+def test_not_modified_has_no_content_type(app, client):
+    etag = client.get("/resource/event/1/summary", headers=admin).headers["ETag"]
+    # Note: the headers are read from the wsgi app, since the test client response adds a default Content-Type
+    app_iter, status, headers = werkzeug.test.run_wsgi_app(app.app.wsgi_app, werkzeug.test.create_environ(
+        "/resource/event/1/summary", headers=dict(admin, **{"If-None-Match": etag})))
+    assert status.startswith("304")
+    assert "Content-Type" not in headers
+
+def test_etag_changes_after_write(client):
+    etag = client.get("/resource/event/1/summary", headers=admin).headers["ETag"]
+    assert client.patch("/resource/event/1", headers=admin, json={"summary": "x"}).status_code == 200
+
+    response = client.get("/resource/event/1/summary", headers=dict(admin, **{"If-None-Match": etag}))
+    assert response.status_code == 200
+    assert response.get_json() == {"id": 1, "summary": "x"}
+    assert response.headers["ETag"] != etag
+
+def test_etag_is_kept_after_failed_write(app, client):
+    etag = client.get("/resource/tag/1/name", headers=admin).headers["ETag"]
+    anonymous = app.app.test_client()  # Note: the test client keeps the session cookie of the authenticated requests
+    assert anonymous.patch("/resource/tag/1", json={"name": "x"}).status_code == 403  # anonymous cannot update tags
+    assert client.patch("/resource/tag/99999", headers=admin, json={"name": "x"}).status_code == 500
+
+    response = client.get("/resource/tag/1/name", headers=dict(admin, **{"If-None-Match": etag}))
+    assert response.status_code == 304
+
+def test_not_modified_is_authorized(app, client):
+    etag = app.resource_etag("tag/1", [])  # anonymous cannot read tags
+    response = client.get("/resource/tag/1", headers={"If-None-Match": etag})
+    assert response.status_code == 403
+
+def test_head(client):
+    for uri in ("/resource/event/1/summary", "/resource/event?/tag=1", "/resource/event/99999"):
+        get, head = client.get(uri, headers=admin), client.head(uri, headers=admin)
+        assert head.status_code == get.status_code
+        # Note: the Content-Length of a successful HEAD is not computed, since its body is not serialized
+        ignored = ("Set-Cookie", "Content-Length") if get.status_code == 200 else ("Set-Cookie",)
+        assert [h for h in head.headers if h[0] not in ignored] == [h for h in get.headers if h[0] not in ignored]
+        assert head.get_data() == b""
+    assert "Content-Length" not in client.head("/resource/event/1/summary", headers=admin).headers
+
+def test_resource_index(client):
+    index = client.get("/resource-index").get_json()
+    assert set(index) == {"event", "tag", "type"}
+    for uri in ("/resource/", "/resource", "/resource-index/"):
+        response = client.get(uri)
+        assert response.status_code == 200
+        assert response.get_json() == index
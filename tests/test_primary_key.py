@@ -0,0 +1,50 @@
+"""
+Tests of `relrest.Service` on models whose primary keys are not named 'id'.
+"""
+
+import pytest
+import sqlalchemy
+from sqlalchemy import orm
+from sqlalchemy.ext.declarative import declarative_base
+
+import relrest
+
+Base = declarative_base()
+
+class A(Base):
+    __tablename__ = "a"
+    uid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    name = sqlalchemy.Column(sqlalchemy.String)
+    b_code = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey("b.code"))
+    b = orm.relationship("B", backref="a")
+
+class B(Base):
+    __tablename__ = "b"
+    code = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+
+@pytest.fixture
+def service():
+    engine = sqlalchemy.create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = orm.sessionmaker(bind=engine)()
+    session.add_all([A(uid=1, name="x", b=B(code="p")), A(uid=2, name="y"), B(code="q")])
+    session.commit()
+    return relrest.Service(session, {"a": A, "b": B})
+
+def test_read_relationships(service):
+    assert service.read("a/+/b?_order=uid") == [{"uid": 1, "/b": "p"}, {"uid": 2, "/b": None}]
+    assert service.read("b/+/a?_order=code") == [{"code": "p", "/a": [1]}, {"code": "q", "/a": []}]
+    assert service.read("a/1/b") == {"uid": 1, "/b": "p"}
+
+def test_write_ids(service):
+    service.update("a/1", {"b": "q"})
+    assert service.read("a/1/b") == {"uid": 1, "/b": "q"}
+    with pytest.raises(sqlalchemy.orm.exc.NoResultFound):
+        service.update("a/1", {"b": "r"})
+    for write in (lambda uri: service.update(uri, {"name": "z"}), service.delete):
+        with pytest.raises(ValueError):
+            write("a/abc")  # Note: the id is marshalled according the primary key type
+        with pytest.raises(sqlalchemy.orm.exc.NoResultFound):
+            write("a/3")
+    service.delete("a/2")
+    assert service.read("a/+/uid") == [{"uid": 1}]
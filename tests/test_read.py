@@ -0,0 +1,77 @@
+"""
+Tests of `relrest.Service.read()` on the fixed dataset (see `conftest.py`).
+"""
+
+import datetime
+
+import pytest
+import sqlalchemy
+
+def test_read_id(service):
+    assert service.read("tag/1") == {"id": 1, "name": "work", "color": "red", "tag_id": None}
+    assert service.read("event/2/summary") == {"id": 2, "summary": "b"}
+    with pytest.raises(sqlalchemy.orm.exc.NoResultFound):
+        service.read("event/99999")
+
+def test_read_relationships(service):
+    record = service.read("event/1/summary,tag")
+    assert sorted(record.pop("/tag")) == [1, 2]  # Note: the relationships are not ordered
+    assert record == {"id": 1, "summary": "a"}
+    assert service.read("tag/3/tag") == {"id": 3, "/tag": []}
+    assert service.read("event/+/type?_order=id") == [
+        {"id": 1, "/type": [1]}, {"id": 2, "/type": [2]}, {"id": 3, "/type": [1]}, {"id": 4, "/type": []}]
+
+def test_read_list(service):
+    assert service.read("event/+/summary?_order=id:desc") == [
+        {"id": 4, "summary": "d"}, {"id": 3, "summary": "c"}, {"id": 2, "summary": "b"}, {"id": 1, "summary": "a"}]
+    assert service.read("event/+/summary?_order=id&_limit=2") == [{"id": 1, "summary": "a"}, {"id": 2, "summary": "b"}]
+    assert service.read("event?summary=c") == [
+        {"id": 3, "summary": "c", "description": None, "time": datetime.datetime(2002, 1, 1)}]
+
+def test_read_stream(service):
+    records = service.read("event/+/summary?_order=id", stream=True)
+    assert not isinstance(records, list)
+    assert list(records) == service.read("event/+/summary?_order=id")
+    assert list(service.read("event/+/tag?_order=id", stream=True)) == service.read("event/+/tag?_order=id")
+
+def test_read_filters(service):
+    # Note: the same request shapes are read with other values, which are bound to the cached queries
+    assert [r["id"] for r in service.read("event/+/id?time.lt=2001-06-01&_order=id")] == [1, 2]
+    assert [r["id"] for r in service.read("event/+/id?time.lt=2002-06-01&_order=id")] == [1, 2, 3]
+    assert [r["id"] for r in service.read("event/+/id?summary.like=%25b%25")] == [2]
+    assert [r["id"] for r in service.read("event/+/id?summary.like=%25c%25")] == [3]
+    assert [r["id"] for r in service.read("tag/+/id?color.ne=red")] == []
+
+def test_read_in_notin(service):
+    # Note: the lists of values are bound to the same cached queries, whatever their length
+    assert [r["id"] for r in service.read("event/+/id?id.in=1,3&_order=id")] == [1, 3]
+    assert [r["id"] for r in service.read("event/+/id?id.in=2,3,4&_order=id")] == [2, 3, 4]
+    assert [r["id"] for r in service.read("event/+/id?id.in=4")] == [4]
+    assert [r["id"] for r in service.read("event/+/id?id.notin=1,2&_order=id")] == [3, 4]
+    assert [r["id"] for r in service.read("event/+/id?id.notin=4&_order=id")] == [1, 2, 3]
+    assert service.session.query(service.model["event"]).filter(service.make_filter("event", "id", "in", [1, 2])).count() == 2
+
+def test_read_count(service):
+    assert service.read("event/+/:count") == {":count": 4}
+    assert service.read("event/+/:count?id.in=1,2") == {":count": 2}
+    assert service.read("event/+/:count?_limit=3") == {":count": 3}
+    assert service.read("event/+/:count?/tag=1") == {":count": 2}
+    assert service.read("+/+/:count?/tag/event") == {":count": 5}  # Note: resourceless requests use outer joins (tag 3 has no event)
+
+def test_read_joinpaths(service):
+    assert [r["id"] for r in service.read("event/+/id?/tag=1&_order=id")] == [1, 2]
+    assert [r["id"] for r in service.read("event/+/id?/tag=2&_order=id")] == [1, 3]
+    assert [r["id"] for r in service.read("event/+/id?/tag.name=home&/type=1&_order=id")] == [1, 3]
+    assert [r["id"] for r in service.read("event/+/id?/tag=1&/type=2")] == [2]
+    # Note: joinpaths sharing a prefix join it once
+    assert [r["id"] for r in service.read("tag/+/id?/event=3/type&/event/type=1&_order=id")] == [2]
+
+def test_read_resourceless(service):
+    assert service.read("+/+/event.summary,tag.name?/event.id.lt=3/tag&_order=event.id,tag.id") == [
+        {"event": {"summary": "a"}, "tag": {"name": "work"}},
+        {"event": {"summary": "a"}, "tag": {"name": "home"}},
+        {"event": {"summary": "b"}, "tag": {"name": "work"}}]
+    assert service.read("-/+/id?/event.id=4/tag") == []  # event 4 has no tag
+    assert service.read("+/+/tag.id?/tag.id=3/event") == [{"tag": {"id": 3}}]  # outer join of a tag without event
+    with pytest.raises(ValueError):
+        service.read("+/1?/tag")
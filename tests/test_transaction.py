@@ -0,0 +1,54 @@
+"""
+Tests of `relrest.Service.transaction()`.
+"""
+
+from sqlalchemy import orm
+
+import data
+import relrest
+
+def test_transaction_commits_on_exit(service):
+    with service.transaction():
+        service.update("event/1", {"summary": "x"})
+        service.update("event/2", {"summary": "y"})
+        assert service.in_transaction()
+    assert not service.in_transaction()
+    service.session.close()
+    assert [service.read("event/1/summary"), service.read("event/2/summary")] == [
+        {"id": 1, "summary": "x"}, {"id": 2, "summary": "y"}]
+
+def test_transaction_rolls_back_on_error(service):
+    try:
+        with service.transaction():
+            service.update("event/1", {"summary": "x"})
+            with service.transaction():  # nested contexts are committed or rolled back by the outermost context
+                service.update("event/2", {"summary": "y"})
+            raise ValueError("abort")
+    except ValueError:
+        pass
+    assert not service.in_transaction()
+    assert [service.read("event/1/summary"), service.read("event/2/summary")] == [
+        {"id": 1, "summary": "a"}, {"id": 2, "summary": "b"}]
+
+def test_transaction_is_kept_by_session(engine):
+    # Note: a scoped session whose scope is switched by hand, as threads (or greenlets) would
+    scope = ["first"]
+    Session = orm.scoped_session(orm.sessionmaker(bind=engine), scopefunc=lambda: scope[0])
+    service = relrest.Service(Session, relrest.util.models_from(data))
+
+    with service.transaction():
+        # the writes of another session are committed, regardless of the transaction of the first session
+        # (which writes after, since sqlite locks the whole database on write)
+        scope[0] = "second"
+        assert not service.in_transaction()
+        service.update("event/2", {"summary": "y"})
+        Session.remove()
+
+        scope[0] = "first"
+        assert service.in_transaction()
+        service.update("event/1", {"summary": "x"})
+
+    scope[0] = "third"
+    assert [service.read("event/1/summary"), service.read("event/2/summary")] == [
+        {"id": 1, "summary": "x"}, {"id": 2, "summary": "y"}]
+    Session.remove()
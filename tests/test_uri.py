@@ -0,0 +1,43 @@
+"""
+Tests of `relrest.util.uri`.
+"""
+
+import pytest
+
+from relrest.util import uri
+
+def test_decode():
+    request = uri.decode("/event/1/summary,tag.name?summary.like=%25a+b%25&/tag=1/type.name=x&_limit=3&_order=time:desc")
+    assert request == uri.Request(
+        resource="event",
+        id="1",
+        fields=((None, "summary"), ("tag", "name")),
+        joinpaths=((("tag", "id", "eq", "1"), ("type", "name", "eq", "x")),),
+        filters=((None, "summary", "like", "%a b%"),),
+        order=((None, "time", "desc"),),
+        limit="3")
+
+def test_request_mapping():
+    request = uri.decode("/event/1/summary?/tag=1")
+    assert request["resource"] == request.resource == "event"
+    assert request["fields"] == request.fields
+    assert dict(request) == request._asdict()
+    with pytest.raises(KeyError):
+        request["nope"]
+    assert uri.encode(**request) == "event/1/summary?/tag.id.eq=1"
+    assert uri.decode(uri.encode(**request)) == request
+
+def test_decode_errors():
+    with pytest.raises(ValueError):
+        uri.decode("/event/1/summary/more")
+    with pytest.raises(ValueError):
+        uri.decode("/event?/tag.id.eq.more=1")
+
+def test_decode_filter_components():
+    assert uri.decode("/event?summary=a").filters == ((None, "summary", "eq", "a"),)
+    assert uri.decode("/event?summary.ne=a").filters == ((None, "summary", "ne", "a"),)
+    assert uri.decode("/event?event.summary.ne=a").filters == (("event", "summary", "ne", "a"),)
+    with pytest.raises(ValueError):
+        uri.decode("/event?a.b.c.d=1")
+    with pytest.raises(ValueError):
+        uri.decode("/event/1/a.b.c")